@@ -0,0 +1,50 @@
+import click
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'migrator'))
+from client_ids import ClientIdIndex, build_index, scan_key_file
+
+
+@click.command()
+@click.option('--lines', default=1000000, help='Number of lines in the generated key file. Default 1000000.')
+@click.option('--lookups', default=100000, help='Number of indexed lookups to time. Default 100000.')
+@click.option('--scans', default=20, help='Number of linear scans to time for comparison. Default 20.')
+def bench_client_ids(lines, lookups, scans):
+    """ Measure client_id lookups per second on a generated key file, for the
+    index and for the old linear scan.
+    """
+    alphabet = string.ascii_letters + string.digits
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        text_path = os.path.join(tmp_dir, '0123456789abcdef')
+        with open(text_path, 'w') as f:
+            for x in range(1, lines + 1):
+                f.write('%s %s\n' % (x, ''.join(random.choice(alphabet) for _ in range(11))))
+
+        start = time.perf_counter()
+        build_index(text_path)
+        print('Index build: %.2fs for %d lines' % (time.perf_counter() - start, lines))
+
+        index = ClientIdIndex(text_path)
+        index.lookup(1) # load the index before timing
+        account_ids = [random.randint(1, lines) for _ in range(lookups)]
+        start = time.perf_counter()
+        for account_id in account_ids:
+            index.lookup(account_id)
+        elapsed = time.perf_counter() - start
+        print('Indexed lookups: %.0f/s' % (lookups / elapsed))
+
+        start = time.perf_counter()
+        for account_id in account_ids[:scans]:
+            scan_key_file(text_path, account_id)
+        elapsed = time.perf_counter() - start
+        print('Linear scans: %.2f/s' % (scans / elapsed))
+        index.close()
+
+
+if __name__ == '__main__':
+    bench_client_ids()
@@ -0,0 +1,89 @@
+import click
+import html
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'migrator'))
+from html_rewriter import rewrite_pad, ATTACHMENTS_URL
+
+
+def legacy_rewrite(html_pad, new_urls):
+    """ The rewrite as insert_pad_from_file used to do it, one pass per step. new_urls
+    stands in for the images that replace_image uploaded.
+    """
+    html_pad = re.sub(r'^.*?<body', '<html><body', html_pad)
+    for tag in re.findall('<a([^>]+)/>', html_pad):
+        html_pad = html_pad.replace('<a'+tag+'/>', '<a'+tag+'>')
+    for tag in re.findall('<img ([^>]+)>', html_pad):
+        html_pad = html_pad.replace('<img '+tag+'>', '<img class="inline-img" faketext="*" contenteditable="false"'+tag+'>')
+    if ATTACHMENTS_URL in html_pad:
+        for image in set(re.findall("src='([^']+)'", html_pad)):
+            image_src = image.strip()
+            if image_src.startswith(ATTACHMENTS_URL):
+                html_pad = html_pad.replace(image_src, new_urls(image_src))
+    m = re.search('<h1.*?>(.+?)</h1>', html_pad)
+    title = None
+    if m:
+        title = html.unescape(re.sub('<[^<]+?>', '', m.group(1))).strip()
+    return html_pad, title
+
+
+def new_url(image_src):
+    return 'https://s3-eu-west-1.amazonaws.com/bench/content/' + image_src.split('/')[-1]
+
+
+def synthetic_pad(size, tags):
+    """ A newline free pad of roughly size bytes with tags a/img tags in it """
+    text = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit &amp; sed do. '
+    filler = max(size - 200 - tags * 120, 0) // (tags + 1)
+    parts = ["<!DOCTYPE html><html><head><meta charset='utf-8'></head><body><h1>Pad <b>title</b> &amp; co</h1>"]
+    for i in range(tags):
+        parts.append('<p>' + (text * (filler // len(text) + 1))[:filler] + '</p>')
+        if i % 4 == 3:
+            # a linked image: the link goes to the uploaded image too
+            image = '%simage_%d.png' % (ATTACHMENTS_URL, random.randint(0, tags // 4))
+            parts.append("<a href='%s'><img src='%s'/></a>" % (image, image))
+        elif i % 2:
+            parts.append("<img src='%simage_%d.png'/>" % (ATTACHMENTS_URL, random.randint(0, tags // 4)))
+        else:
+            parts.append("<a href='http://example.com/%d'/>link</a>" % i)
+    parts.append('<p>' + (text * (filler // len(text) + 1))[:filler] + '</p></body></html>')
+    return ''.join(parts)
+
+
+@click.command()
+@click.option('--repeat', default=3, help='Number of runs per pad, the best one counts. Default 3.')
+def bench_html_rewrite(repeat):
+    """ Compare the single pass rewrite with the old multi pass one on synthetic pads
+    from 1 KB to 10 MB with 0 to 5000 tags.
+    """
+    resolve = lambda image_srcs: dict((image_src, new_url(image_src)) for image_src in image_srcs)
+    linked = "<body><h1>Linked</h1><a href='%sx.png'><img src='%sx.png'/></a><a href='%sx.png'/>x</a></body>" % (
+        (ATTACHMENTS_URL,) * 3)
+    if legacy_rewrite(linked, new_url) != rewrite_pad(linked, resolve):
+        raise click.ClickException('Output differs for a linked image')
+    print('%10s %6s %12s %12s %8s' % ('size', 'tags', 'legacy (ms)', 'single (ms)', 'speedup'))
+    for size in (1024, 100 * 1024, 1024 * 1024, 10 * 1024 * 1024):
+        for tags in (0, 50, 500, 5000):
+            if tags * 120 > size:
+                continue
+            pad = synthetic_pad(size, tags)
+            if legacy_rewrite(pad, new_url) != rewrite_pad(pad, resolve):
+                raise click.ClickException('Output differs for size %d with %d tags' % (size, tags))
+            timings = []
+            for rewrite in (lambda: legacy_rewrite(pad, new_url), lambda: rewrite_pad(pad, resolve)):
+                best = None
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    rewrite()
+                    elapsed = time.perf_counter() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                timings.append(best * 1000)
+            print('%10d %6d %12.2f %12.2f %7.1fx' % (len(pad), tags, timings[0], timings[1], timings[0] / timings[1]))
+
+
+if __name__ == '__main__':
+    bench_html_rewrite()
@@ -0,0 +1,466 @@
+import click
+import json
+import os
+import random
+import resource
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+MIGRATOR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'migrator')
+sys.path.insert(0, MIGRATOR_DIR)
+from html_rewriter import ATTACHMENTS_URL
+from pad_index import BOILERPLATE_PADS, fingerprint
+
+LOREM = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit &amp; sed do eiusmod tempor. '
+# The default pad of a new hackpad as a file that is sniffed as html, the bare body is
+# text/plain to libmagic. The worker is told its fingerprint is boilerplate.
+DEFAULT_PAD = "<!DOCTYPE html><html><head><meta charset='utf-8'></head>%s</html>" % BOILERPLATE_PADS[0]
+# Finished jobs, pushed by the benchmarked worker
+FINISHED_KEY = 'hackpad_bench_finished'
+
+
+def synthetic_pad(pad_index, size, image_names):
+    """ A pad like the hackpad exports of roughly size bytes, with an image for every name
+    in image_names
+    """
+    filler = max(size - 300 - len(image_names) * 120, 0) // (len(image_names) + 1)
+    paragraph = (LOREM * (filler // len(LOREM) + 1))[:filler]
+    parts = ["<!DOCTYPE html><html><head><meta charset='utf-8'></head>\n<body><h1>Pad %d &amp; co</h1>" % pad_index]
+    for image_name in image_names:
+        parts.append('<p>%s</p>\n' % paragraph)
+        parts.append("<p><img src='%s%s'><a href='http://example.com/%d'/>link</a></p>" % (
+            ATTACHMENTS_URL, image_name, pad_index))
+    parts.append('<p>%s</p></body></html>\n' % paragraph)
+    return ''.join(parts)
+
+
+def synthetic_export(path, job_index, pads, pad_size, images, bmp_share, default_share):
+    """ Write a hackpad export zip with pads pads of about pad_size bytes and images
+    images per pad. bmp_share of the images need transcoding, default_share of the pads
+    are the untouched default pad.
+    """
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+        for pad_index in range(pads):
+            if random.random() < default_share:
+                zip_ref.writestr('default-%d.html' % pad_index, DEFAULT_PAD)
+                continue
+            image_names = ['job%d-pad%d-%d.%s' % (job_index, pad_index, image_index,
+                                                  'bmp' if random.random() < bmp_share else 'png')
+                           for image_index in range(images)]
+            zip_ref.writestr('pad-%d.html' % pad_index, synthetic_pad(pad_index, pad_size, image_names))
+
+
+def png_bytes(size):
+    """ Bytes that pass as a PNG for the upload, they are never decoded """
+    return b'\x89PNG\r\n\x1a\n' + os.urandom(max(size - 8, 0))
+
+
+def bmp_bytes(width=64, height=64):
+    """ A real 24 bit BMP, which the worker has to transcode to PNG """
+    row = bytes(random.randrange(256) for _ in range(width * 3)) + b'\0' * (-width * 3 % 4)
+    pixels = row * height
+    header = struct.pack('<2sIHHI', b'BM', 54 + len(pixels), 0, 0, 54)
+    info = struct.pack('<IiiHHIIiiII', 40, width, height, 1, 24, 0, len(pixels), 2835, 2835, 0, 0)
+    return header + info + pixels
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise click.ClickException('Nothing listens on port %d' % port)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+class Latency(object):
+    """ Lognormal latency around a median, and a share of failures """
+
+    def __init__(self, median, errors=0.0, spread=0.5):
+        self.median = median
+        self.errors = errors
+        self.spread = spread
+
+    def delay(self):
+        return random.lognormvariate(0, self.spread) * self.median if self.median else 0
+
+    def fails(self):
+        return random.random() < self.errors
+
+
+@click.group()
+def bench_pipeline():
+    """ End-to-end benchmark of the migrator, fully offline. The Hackpad API, S3, SMTP and
+    MySQL are replaced by local stand-ins, Redis by a local redis-server.
+    """
+
+
+@bench_pipeline.command()
+@click.option('--jobs', default=10, help='Number of import jobs. Default 10.')
+@click.option('--pads', default=50, help='Number of pads per job. Default 50.')
+@click.option('--pad-size', default=20000, help='Size of a pad in bytes. Default 20000.')
+@click.option('--images', default=2, help='Number of images per pad. Default 2.')
+@click.option('--image-size', default=30000, help='Size of the PNG images in bytes. Default 30000.')
+@click.option('--bmp-share', default=0.1, help='Share of images that need transcoding. Default 0.1.')
+@click.option('--default-share', default=0.05, help='Share of untouched default pads. Default 0.05.')
+@click.option('--api-latency', default=0.05, help='Median latency of the Hackpad API in seconds. Default 0.05.')
+@click.option('--api-errors', default=0.0, help='Share of failing Hackpad API calls. Default 0.')
+@click.option('--s3-latency', default=0.02, help='Median latency of S3 in seconds. Default 0.02.')
+@click.option('--s3-errors', default=0.0, help='Share of failing S3 requests. Default 0.')
+@click.option('--smtp-latency', default=0.01, help='Median latency of an SMTP command in seconds. Default 0.01.')
+@click.option('--mysql-latency', default=0.002, help='Median latency of a MySQL query in seconds. Default 0.002.')
+@click.option('--mysql-errors', default=0.0, help='Share of failing MySQL queries. Default 0.')
+@click.option('--spread', default=0.5, help='Sigma of the lognormal latencies. Default 0.5.')
+@click.option('--redis-port', default=0, help='Port of a Redis to use (its db 15 is flushed), default: start a redis-server.')
+@click.option('--timeout', default=600, help='Seconds to wait for the jobs. Default 600.')
+@click.option('--keep', is_flag=True, help='Keep the work directory with the zips and logs.')
+def run(jobs, pads, pad_size, images, image_size, bmp_share, default_share, api_latency, api_errors,
+        s3_latency, s3_errors, smtp_latency, mysql_latency, mysql_errors, spread, redis_port, timeout, keep):
+    """ Generate export zips, start the stand-ins and a worker, import all jobs and report
+    jobs/min, pads/sec, per-pad latency and the peak RSS of the worker.
+    """
+    import redis
+    work_dir = tempfile.mkdtemp(prefix='hackpad-bench-')
+    os.mkdir(os.path.join(work_dir, 'attachments'))
+    click.echo('Generating %d zips with %d pads in %s' % (jobs, pads, work_dir))
+    zip_paths = []
+    for job_index in range(jobs):
+        zip_path = os.path.join(work_dir, 'attachments', 'bench-%d.zip' % job_index)
+        synthetic_export(zip_path, job_index, pads, pad_size, images, bmp_share, default_share)
+        zip_paths.append(zip_path)
+
+    # client ids of the accounts the fake MySQL hands out, and a profile for boto3
+    with open(os.path.join(work_dir, 'bench'), 'w') as f:
+        for account_id in range(1, jobs + 1):
+            f.write('%d bench-client-%d\n' % (account_id, account_id))
+    with open(os.path.join(work_dir, 'aws_credentials'), 'w') as f:
+        f.write('[stekpad]\naws_access_key_id = bench\naws_secret_access_key = bench\n')
+    with open(os.path.join(work_dir, 'aws_config'), 'w') as f:
+        f.write('[profile stekpad]\nregion = eu-west-1\ns3 =\n    addressing_style = path\n')
+
+    processes = []
+    try:
+        if not redis_port:
+            redis_port = free_port()
+            processes.append(subprocess.Popen(['redis-server', '--port', str(redis_port), '--save', '',
+                                               '--appendonly', 'no'], cwd=work_dir, stdout=subprocess.DEVNULL))
+        wait_for_port(redis_port)
+        rdb = redis.StrictRedis(port=redis_port, db=15)
+        rdb.flushdb()
+
+        api_port, s3_port, smtp_port = free_port(), free_port(), free_port()
+        standins = subprocess.Popen([sys.executable, __file__, 'standins', '--api-port', str(api_port),
+                                     '--s3-port', str(s3_port), '--smtp-port', str(smtp_port),
+                                     '--image-size', str(image_size), '--api-latency', str(api_latency),
+                                     '--api-errors', str(api_errors), '--s3-latency', str(s3_latency),
+                                     '--s3-errors', str(s3_errors), '--smtp-latency', str(smtp_latency),
+                                     '--spread', str(spread), '--stats', os.path.join(work_dir, 'standins.json')])
+        processes.append(standins)
+        for port in (api_port, s3_port, smtp_port):
+            wait_for_port(port)
+
+        env = dict(os.environ,
+                   HACKPAD_REDIS_PORT=str(redis_port), HACKPAD_REDIS_DB='15',
+                   HACKPAD_API_SCHEME='http', HACKPAD_API_DOMAIN='127.0.0.1:%d' % api_port, HACKPAD_SUB_DOMAIN='',
+                   HACKPAD_S3_ENDPOINT='http://127.0.0.1:%d' % s3_port,
+                   HACKPAD_ATTACHMENTS_ENDPOINT='http://127.0.0.1:%d/hackpad-attachments' % s3_port,
+                   HACKPAD_SMPT_HOST='127.0.0.1', HACKPAD_SMPT_PORT=str(smtp_port),
+                   HACKPAD_SMPT_USER='', HACKPAD_SMPT_PASSWORD='', HACKPAD_CLIENT_IDS_PATH=work_dir + '/', HACKPAD_ACCOUNT_ID_KEY='bench',
+                   HACKPAD_METRICS_PORT=os.environ.get('HACKPAD_METRICS_PORT') or '0',
+                   HACKPAD_BOILERPLATE_FINGERPRINTS=','.join(
+                       [fingerprint(DEFAULT_PAD), os.environ.get('HACKPAD_BOILERPLATE_FINGERPRINTS') or '']),
+                   AWS_SHARED_CREDENTIALS_FILE=os.path.join(work_dir, 'aws_credentials'),
+                   AWS_CONFIG_FILE=os.path.join(work_dir, 'aws_config'))
+        worker = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'worker',
+                                   '--mysql-latency', str(mysql_latency), '--mysql-errors', str(mysql_errors),
+                                   '--spread', str(spread), '--results', os.path.join(work_dir, 'worker.json')],
+                                  cwd=work_dir, env=env)
+        processes.append(worker)
+
+        start = time.monotonic()
+        for zip_path in zip_paths:
+            rdb.lpush('hackpad_imports', json.dumps({'from': 'Bench <bench@example.com>',
+                                                     'email_address': 'bench-%s@example.com' % os.path.basename(zip_path),
+                                                     'attachment': zip_path, 'queued_at': time.time()}))
+        while rdb.llen(FINISHED_KEY) < jobs:
+            if worker.poll() is not None:
+                raise click.ClickException('The worker exited with %s' % worker.returncode)
+            if time.monotonic() - start > timeout:
+                raise click.ClickException('Only %d of %d jobs finished in %ds' % (rdb.llen(FINISHED_KEY), jobs, timeout))
+            time.sleep(0.1)
+        elapsed = time.monotonic() - start
+        finished = rdb.hlen('hackpad_done')
+
+        worker.send_signal(signal.SIGTERM)
+        worker.wait()
+        standins.send_signal(signal.SIGTERM)
+        standins.wait()
+        with open(os.path.join(work_dir, 'worker.json')) as f:
+            results = json.load(f)
+        with open(os.path.join(work_dir, 'standins.json')) as f:
+            standin_stats = json.load(f)
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+                process.wait()
+
+    latencies = results['pad_latencies']
+    click.echo('%d jobs (%d finished), %d pads created, %d skipped in %.1fs' % (
+        jobs, finished, results['pads_created'], results['pads_skipped'], elapsed))
+    click.echo('%10.1f jobs/min' % (jobs / elapsed * 60))
+    click.echo('%10.1f pads/sec' % (results['pads_created'] / elapsed))
+    click.echo('%10.1f ms p50 pad latency' % (percentile(latencies, 0.5) * 1000))
+    click.echo('%10.1f ms p99 pad latency' % (percentile(latencies, 0.99) * 1000))
+    click.echo('%10.1f MB peak RSS of the worker' % (results['peak_rss_kb'] / 1024))
+    click.echo('Stand-ins: %s' % ', '.join('%s %d' % item for item in sorted(standin_stats.items())))
+    if keep:
+        click.echo('Kept %s' % work_dir)
+    else:
+        subprocess.call(['rm', '-rf', work_dir])
+
+
+@bench_pipeline.command()
+@click.option('--api-port', type=int, required=True)
+@click.option('--s3-port', type=int, required=True)
+@click.option('--smtp-port', type=int, required=True)
+@click.option('--image-size', default=30000)
+@click.option('--api-latency', default=0.05)
+@click.option('--api-errors', default=0.0)
+@click.option('--s3-latency', default=0.02)
+@click.option('--s3-errors', default=0.0)
+@click.option('--smtp-latency', default=0.01)
+@click.option('--spread', default=0.5)
+@click.option('--stats', required=True, help='File to write the request counts to on exit.')
+def standins(api_port, s3_port, smtp_port, image_size, api_latency, api_errors, s3_latency, s3_errors,
+             smtp_latency, spread, stats):
+    """ Serve the Hackpad API, hackpad-attachments plus our bucket, and SMTP on localhost """
+    from gevent import monkey
+    monkey.patch_all()
+    import gevent
+    from gevent.event import Event
+    from gevent.pywsgi import WSGIServer
+    from gevent.server import StreamServer
+
+    api = Latency(api_latency, api_errors, spread)
+    s3 = Latency(s3_latency, s3_errors, spread)
+    smtp = Latency(smtp_latency, 0, spread)
+    counts = {'api_calls': 0, 'api_errors': 0, 's3_gets': 0, 's3_heads': 0, 's3_puts': 0, 's3_errors': 0,
+              's3_bytes_in': 0, 'mails': 0}
+    uploaded = set()
+    images = {'png': png_bytes(image_size), 'bmp': bmp_bytes()}
+
+    def hackpad_api(environ, start_response):
+        counts['api_calls'] += 1
+        environ['wsgi.input'].read()
+        gevent.sleep(api.delay())
+        if api.fails():
+            counts['api_errors'] += 1
+            start_response('500 Internal Server Error', [('Content-Type', 'application/json')])
+            return [b'{"success": false}']
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        return [json.dumps({'success': True, 'globalPadId': 'bench-%d' % counts['api_calls']}).encode()]
+
+    def s3_api(environ, start_response):
+        method, path = environ['REQUEST_METHOD'], environ['PATH_INFO']
+        body = environ['wsgi.input'].read()
+        gevent.sleep(s3.delay())
+        if s3.fails():
+            counts['s3_errors'] += 1
+            start_response('503 Slow Down', [('Content-Type', 'application/xml')])
+            return [b'<Error><Code>SlowDown</Code><Message>bench</Message></Error>']
+        if method == 'GET' and path.startswith('/hackpad-attachments/'):
+            counts['s3_gets'] += 1
+            start_response('200 OK', [('Content-Type', 'application/octet-stream')])
+            return [images['bmp' if path.endswith('.bmp') else 'png']]
+        if method == 'HEAD':
+            counts['s3_heads'] += 1
+            start_response('200 OK' if path in uploaded else '404 Not Found', [('Content-Length', '0')])
+            return []
+        if method == 'PUT':
+            counts['s3_puts'] += 1
+            counts['s3_bytes_in'] += len(body)
+            uploaded.add(path)
+            start_response('200 OK', [('ETag', '"bench"'), ('Content-Length', '0')])
+            return []
+        start_response('404 Not Found', [('Content-Type', 'text/plain')])
+        return [b'Not found']
+
+    def smtp_session(sock, address):
+        """ Just enough SMTP for smtplib """
+        reader = sock.makefile('rb')
+        def reply(line):
+            gevent.sleep(smtp.delay())
+            sock.sendall(line.encode() + b'\r\n')
+        reply('220 bench ESMTP')
+        for line in reader:
+            command = line.strip().upper()
+            if command.startswith(b'EHLO'):
+                reply('250-bench\r\n250 8BITMIME')
+            elif command == b'DATA':
+                reply('354 End data with <CR><LF>.<CR><LF>')
+                for data_line in reader:
+                    if data_line.rstrip(b'\r\n') == b'.':
+                        break
+                counts['mails'] += 1
+                reply('250 OK')
+            elif command == b'QUIT':
+                reply('221 Bye')
+                break
+            else:
+                reply('250 OK')
+        sock.close()
+
+    servers = [WSGIServer(('127.0.0.1', api_port), hackpad_api, log=None),
+               WSGIServer(('127.0.0.1', s3_port), s3_api, log=None),
+               StreamServer(('127.0.0.1', smtp_port), smtp_session)]
+    for server in servers:
+        server.start()
+    stopped = Event()
+    gevent.signal_handler(signal.SIGTERM, stopped.set)
+    stopped.wait()
+    for server in servers:
+        server.stop()
+    with open(stats, 'w') as f:
+        json.dump(counts, f)
+
+
+class FakeMySQL(object):
+    """ The pro_accounts and pro_tokens tables, for the queries of provision_accounts """
+
+    def __init__(self, latency, error):
+        self.latency = latency
+        self.error = error
+        self.accounts = {} # (domainId, email) -> id
+        self.tokens = {} # (userId, tokenType) -> token
+
+    def connect(self):
+        return FakeConnection(self)
+
+
+class FakeConnection(object):
+
+    def __init__(self, db):
+        self.db = db
+
+    def cursor(self, prepared=False):
+        return FakeCursor(self.db)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def ping(self, reconnect=False):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeCursor(object):
+
+    def __init__(self, db):
+        self.db = db
+        self.column_names = ()
+        self._rows = []
+
+    def execute(self, query, args):
+        import gevent
+        gevent.sleep(self.db.latency.delay())
+        if self.db.latency.fails():
+            raise self.db.error('Injected MySQL failure')
+        query = ' '.join(query.split())
+        if query.startswith('SELECT id, email FROM pro_accounts'):
+            # the email column has a case insensitive collation
+            domain_id, emails = args[0], set(email.lower() for email in args[1:])
+            self.column_names = ('id', 'email')
+            self._rows = [(account_id, email) for (domain, email), account_id in self.db.accounts.items()
+                          if domain == domain_id and email.lower() in emails]
+        elif query.startswith('INSERT INTO pro_accounts'):
+            for domain_id, full_name, email in zip(args[0::3], args[1::3], args[2::3]):
+                self.db.accounts[(domain_id, email)] = len(self.db.accounts) + 1
+        elif query.startswith('SELECT userId, token FROM pro_tokens'):
+            token_type, account_ids = args[0], set(args[1:])
+            self.column_names = ('userId', 'token')
+            self._rows = [(account_id, token) for (account_id, kind), token in self.db.tokens.items()
+                          if kind == token_type and account_id in account_ids]
+        elif query.startswith('INSERT INTO pro_tokens'):
+            for account_id, token_type, token in zip(args[0::3], args[1::3], args[2::3]):
+                self.db.tokens[(account_id, token_type)] = token
+        else:
+            raise self.db.error('Query not known to the fake: %s' % query)
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+
+@bench_pipeline.command()
+@click.option('--mysql-latency', default=0.002)
+@click.option('--mysql-errors', default=0.0)
+@click.option('--spread', default=0.5)
+@click.option('--results', required=True, help='File to write the pad latencies and peak RSS to on exit.')
+def worker(mysql_latency, mysql_errors, spread, results):
+    """ Run a migrator worker with MySQL replaced by an in-memory fake, until SIGTERM """
+    import importlib.util
+    spec = importlib.util.spec_from_file_location('migrator_worker', os.path.join(MIGRATOR_DIR, '__init__.py'))
+    migrator = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(migrator)
+    from db_pool import ConnectionPool
+
+    fake_db = FakeMySQL(Latency(mysql_latency, mysql_errors, spread), migrator.mysql.connector.errors.OperationalError)
+    migrator.db_pool = ConnectionPool(fake_db.connect)
+
+    pad_latencies = []
+    insert_pad_from_file = migrator.insert_pad_from_file
+    def timed_insert_pad_from_file(*args):
+        start = time.monotonic()
+        try:
+            return insert_pad_from_file(*args)
+        finally:
+            pad_latencies.append(time.monotonic() - start)
+    migrator.insert_pad_from_file = timed_insert_pad_from_file
+
+    import_pads = migrator.import_pads
+    def reporting_import_pads(job_state, job, job_id, account):
+        try:
+            import_pads(job_state, job, job_id, account)
+        finally:
+            job_state.rdb.rpush(FINISHED_KEY, job_id)
+    migrator.import_pads = reporting_import_pads
+
+    migrator.process_next_job()
+    with open(results, 'w') as f:
+        json.dump({'pad_latencies': pad_latencies,
+                   'pads_created': migrator.worker_stats['pads_created'],
+                   'pads_skipped': migrator.worker_stats['pads_skipped'],
+                   'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}, f)
+
+
+if __name__ == '__main__':
+    bench_pipeline()
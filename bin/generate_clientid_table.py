@@ -1,31 +1,67 @@
 import click
+import os
 import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'migrator'))
+
+
+def crypto_client_id(account_id_encryption_key, account_id):
+    """ Run crypto.jar for one account id and return its client_id """
+    # java -jar crypto.jar 0123456789abcdef 6
+    result = subprocess.run(['java', '-jar', 'crypto.jar', account_id_encryption_key, str(account_id)],
+                            stdout=subprocess.PIPE, check=True)
+    return result.stdout.decode('utf-8').strip()
+
 
 @click.command()
 @click.option('--count', default=10, help='Number of client_id\'s to generate. Default 10.')
 @click.option('--path', default='../client_ids/',
               help='Location of the lookup files, including trailing slash. Default is ../client_ids/')
+@click.option('--workers', default=1, help='Number of crypto.jar processes that run at the same time. Default 1.')
+@click.option('--index/--no-index', default=False, help='Also write the index the migrator looks client_id\'s up in.')
 @click.argument('account_id_encryption_key')
-def generate_client_ids(count, path, account_id_encryption_key):
-    """ Use the crypto.jar executable to generate more client_id's 
+def generate_client_ids(count, path, workers, index, account_id_encryption_key):
+    """ Use the crypto.jar executable to generate more client_id's
     for the hackpad API. Every run it generates an additional 10
+
+    crypto.jar encrypts one account id per run, so with --workers several of them run in
+    parallel. The new file is written next to the old one and renamed over it, so a
+    failed run leaves the old file as it was.
     """
+    file_path = path + account_id_encryption_key
+
+    # Read the existing lines (if any), to continue numbering after them
+    lines = []
+    if os.path.exists(file_path):
+        with open(file_path) as f:
+            lines = [line for line in f]
+        if lines and not lines[-1].endswith('\n'):
+            lines[-1] += '\n'
+    num_lines = len(lines)
+
+    # Generate client_ids, in order of account id
+    account_ids = range(num_lines+1, num_lines+count+1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        client_ids = executor.map(lambda account_id: crypto_client_id(account_id_encryption_key, account_id),
+                                  account_ids)
+        for account_id, client_id in zip(account_ids, client_ids):
+            print('Adding line: %s %s' % (account_id, client_id))
+            lines.append('%s %s\n' % (account_id, client_id))
+
+    tmp_path = '%s.tmp.%d' % (file_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.writelines(lines)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
+
+    if index:
+        from client_ids import build_index, INDEX_SUFFIX
+        count = build_index(file_path)
+        print('Wrote index %s with %d records' % (file_path + INDEX_SUFFIX, count))
+
 
-    # Open the file (or create it if non existing) and read number of lines
-    with open(path + account_id_encryption_key, 'a+') as f:
-        # Read the number of account id's for the specific key
-        num_lines = 0
-        f.seek(0)
-        for num_lines, l in enumerate(f, 1): pass
-
-    # Generate client_ids and append to file
-    with open(path + account_id_encryption_key, 'a') as f:                
-        for x in range(num_lines+1, num_lines+count+1):
-            # java -jar crypto.jar 0123456789abcdef 6
-            result = subprocess.run(['java', '-jar', 'crypto.jar', account_id_encryption_key, str(x)], stdout=subprocess.PIPE)
-            client_id = result.stdout.decode('utf-8')
-            print('Adding line: %s %s' % (x, client_id))
-            f.write("%s %s" % (x, client_id))
-            
 if __name__ == '__main__':
     generate_client_ids()
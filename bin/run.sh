@@ -24,6 +24,10 @@ cd "$SCRIPTPATH/../"
 # Activate Virtual Env
 source "$VENV_NAME/bin/activate"
 
-# Run script
-python3 migrator/__init__.py
+# Run script: "run.sh fleet" runs a supervised worker per core
+if [[ "$1" == "fleet" ]]; then
+    python3 migrator/supervisor.py
+else
+    python3 migrator/__init__.py
+fi
 deactivate
\ No newline at end of file
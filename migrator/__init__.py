@@ -2,6 +2,11 @@
 This module imports hackpad.com exported pads into another hackpad instance (like stekpad.com)
 """
 
+# Patch before anything else imports socket, ssl or threading, so all network I/O
+# (redis, mysql.connector, boto3/botocore, requests) is cooperative
+from gevent import monkey
+monkey.patch_all()
+
 import os
 import mysql.connector
 import redis
@@ -10,21 +15,62 @@ import string
 import re
 import time
 import magic
-import html
+import io
 import json
+import signal
 import gevent
+from gevent.event import Event
 from gevent.pool import Pool
+from gevent.lock import BoundedSemaphore
 from logger import logging
 import zipfile
-from hackpad_api.hackpad import Hackpad
-from image_uploader import replace_image
-from send_email import send_html_email, send_text_email
-from gevent import monkey
-monkey.patch_all()
+from collections import OrderedDict
+from hackpad_client import hackpad_api, watch_drained
+from image_uploader import upload_images, pop_image_stats
+from image_cache import image_cache
+from pad_index import pad_index, fingerprint, BOILERPLATE
+from html_rewriter import scan_pad
+from client_ids import lookup_client_id
+from db_pool import ConnectionPool, prepared
+from job_state import JobState
+from send_email import send_html_email, send_text_email, outbox
+from hub import run_blocking, stage, start_monitor
+from scheduler import Scheduler, ScheduledJob, inspect_zip
+from concurrency import ConcurrencyController
+from memory_budget import pad_budget
+import metrics
 
 
 EMULATE_INSERTS_DELAY = 0 # real inserts when 0, otherwise delay per fake insert in seconds
 
+# Number of pads of one job that are imported at the same time
+HACKPAD_PAD_CONCURRENCY = int(os.environ.get('HACKPAD_PAD_CONCURRENCY') or 4)
+# Cap on pads being imported at the same time by all jobs together
+pad_slots = BoundedSemaphore(int(os.environ.get('HACKPAD_MAX_INFLIGHT_PADS') or 8))
+# 'stream' reads the pads straight out of the zip, 'extract' unzips them into ./data first
+HACKPAD_INGEST_MODE = os.environ.get('HACKPAD_INGEST_MODE') or 'stream'
+# Number of leading bytes of a pad used to sniff its mime type
+SNIFF_BYTES = 512
+# Bytes of memory a pad takes per byte of the file while it is imported: the text, the
+# scanned pieces, the rewritten html and the request body
+PAD_MEMORY_FACTOR = int(os.environ.get('HACKPAD_PAD_MEMORY_FACTOR') or 5)
+# Max number of queued jobs whose accounts and tokens are provisioned together
+HACKPAD_PROVISION_WINDOW = int(os.environ.get('HACKPAD_PROVISION_WINDOW') or 20)
+# Seconds to wait before taking jobs again after provisioning failed on a MySQL error
+HACKPAD_PROVISION_RETRY_DELAY = float(os.environ.get('HACKPAD_PROVISION_RETRY_DELAY') or 10)
+# Max seconds to wait before looking at the queue again when none of the popped jobs could
+# start, unless a job finishes first
+HACKPAD_SCHEDULER_RETRY_DELAY = float(os.environ.get('HACKPAD_SCHEDULER_RETRY_DELAY') or 10)
+
+# Per thread state of the threadpool: handles on the zips and libmagic
+_thread_state = monkey.get_original('threading', 'local')()
+
+# Counters of this worker, published with its heartbeat for the supervisor
+worker_stats = {'jobs_started': 0, 'jobs_finished': 0, 'jobs_failed': 0, 'pads_created': 0, 'pads_skipped': 0}
+metrics.Gauge('hackpad_jobs_total', 'Jobs of this worker by state',
+              lambda: dict((name[5:], value) for name, value in worker_stats.items() if name.startswith('jobs_')),
+              label='state', kind='counter')
+
 # TODO
 # remove stek specific email data
 
@@ -36,7 +82,27 @@ def process_next_job():
 
     hackpad_max_concurrent_jobs = os.environ.get('HACKPAD_MAX_CONCURRENT_JOBS') or 3
     
+    # report greenlets that keep the hub to themselves
+    start_monitor()
+
     rdb = redis.StrictRedis(host=hackpad_rdb_host, port=hackpad_rdb_port, db=hackpad_rdb_db)
+    metrics.Gauge('hackpad_queue_depth', 'Jobs waiting in hackpad_imports and running in hackpad_processing',
+                  lambda: {'imports': rdb.llen('hackpad_imports'), 'processing': rdb.hlen('hackpad_processing')},
+                  label='queue')
+    metrics.serve()
+    # share the list of uploaded images with the other workers
+    image_cache.attach(rdb)
+    # and the fingerprints of the pads imported per account
+    pad_index.attach(rdb)
+    # and the API nodes operators took out of use
+    watch_drained(rdb)
+    # put the jobs of crashed workers back in the queue
+    job_state = JobState(rdb, stats=worker_stats)
+    job_state.start()
+
+    # On SIGTERM stop taking jobs and finish the running ones
+    stopping = []
+    gevent.signal_handler(signal.SIGTERM, lambda: stopping.append(True))
 
     if EMULATE_INSERTS_DELAY > 0:        
         rdb.lpush('hackpad_imports', json.dumps({
@@ -61,171 +127,359 @@ def process_next_job():
         }))
 
     pool = Pool(int(hackpad_max_concurrent_jobs))
+    # decides which of the popped jobs runs next, small ones first and fair per sender
+    scheduler = Scheduler(int(hackpad_max_concurrent_jobs))
+    # and how many of them run, by the backlog and the health of the services
+    controller = ConcurrencyController(rdb, scheduler, job_state.worker_id)
+    controller.start()
+    job_done = Event()
+
+    def job_finished(scheduled):
+        scheduler.finished(scheduled)
+        job_done.set()
+
+    requeued_at = None
+    while not stopping:
+        # start what can start, then only take more jobs when there is room for them
+        scheduled = scheduler.next_job()
+        while scheduled:
+            logging.info('Starting %s job %s (%d files, %d bytes) for %s' % (
+                scheduled.size_class, scheduled.job_id, scheduled.members, scheduled.size, scheduled.sender))
+            pool.spawn(import_pads, job_state, scheduled.job, scheduled.job_id, scheduled.account).link(
+                lambda greenlet, scheduled=scheduled: job_finished(scheduled))
+            scheduled = scheduler.next_job()
+        if requeued_at is not None:
+            # none of the popped jobs could start, look again when one of ours finished
+            if not job_done.is_set() and time.monotonic() - requeued_at < HACKPAD_SCHEDULER_RETRY_DELAY:
+                job_done.wait(timeout=1)
+                continue
+            requeued_at = None
+        if not scheduler.can_pop():
+            job_done.clear()
+            job_done.wait(timeout=1)
+            continue
+        job = rdb.brpop('hackpad_imports', timeout=1)
+        if not job or stopping:
+            if job: # give it back
+                rdb.rpush('hackpad_imports', job[1])
+            continue
+        # look at a window of jobs, to find the ones that fit the free slots
+        raw_jobs = [job[1]] + drain_jobs(rdb, HACKPAD_PROVISION_WINDOW - 1)
+
+        jobs = []
+        claimed = []
+        for raw_job in raw_jobs:
+            job_obj = json.loads(raw_job.decode('utf-8'))
+            m = re.search('^.+attachments/(.+)\.zip$', job_obj['attachment'])
+            job_id = m.group(1)
+            jobs.append((job_id, job_obj))
+            claimed.append((job_id, raw_job))
+
+        # move jobs to temporary hash
+        job_state.claim(claimed)
+
+        candidates = []
+        for (job_id, job_obj), (_, raw_job) in zip(jobs, claimed):
+            # the size of the job, from the central directory of its zip
+            try:
+                members, size = run_blocking('zip inspect', inspect_zip, job_obj['attachment'])
+            except (OSError, zipfile.BadZipFile) as err:
+                logging.error('Could not inspect the zip of job %s: %s' % (job_id, err))
+                members, size = 0, 0
+            candidates.append(ScheduledJob(job_id, job_obj, raw_job, members, size))
+        fitting, rest = scheduler.split(candidates)
+        if rest:
+            # back in front of the queue, in the order they were in
+            job_state.release([(scheduled.job_id, scheduled.raw_job) for scheduled in reversed(rest)])
+        if not fitting:
+            job_done.clear()
+            requeued_at = time.monotonic()
+            continue
+
+        # Resolve the accounts and tokens of all jobs in one go
+        accounts = provision_accounts([(scheduled.job_id, scheduled.job) for scheduled in fitting])
+        if accounts is None:
+            # MySQL failed, the jobs go back to the queue for another try
+            job_state.release([(scheduled.job_id, scheduled.raw_job) for scheduled in reversed(fitting)])
+            gevent.sleep(HACKPAD_PROVISION_RETRY_DELAY)
+            continue
+
+        for scheduled in fitting:
+            if scheduled.job_id not in accounts:
+                # the error was emailed, keep the job for an operator
+                job_state.fail(scheduled.job_id)
+                continue
+            scheduled.account = accounts[scheduled.job_id]
+            scheduler.add(scheduled)
+
+    # jobs that did not start go back to the queue, for this or another worker
+    waiting = scheduler.drain_waiting()
+    if waiting:
+        logging.info('Draining: putting %d waiting jobs back in the queue' % len(waiting))
+        job_state.release([(scheduled.job_id, scheduled.raw_job) for scheduled in waiting])
+    logging.info('Draining: waiting for %d running jobs' % (pool.size - pool.free_count()))
+    pool.join()
+    outbox.flush()
+    job_state.stop()
+    logging.info('Worker stopped')
+
+
+def drain_jobs(rdb, count):
+    """ Pop up to count more jobs that are waiting in the queue, without blocking """
+    if count <= 0:
+        return []
+    pipe = rdb.pipeline()
+    for _ in range(count):
+        pipe.rpop('hackpad_imports')
+    return [raw_job for raw_job in pipe.execute() if raw_job]
+
+
+def import_pads(job_state, job, job_id, account):
+    """ Import the pads for one account. account is the (account_id, new_account,
+    client_secret, client_id) tuple from provision_accounts.
+    """
+    account_id, new_account, client_secret, client_id = account
+    # producers that stamp their jobs with queued_at (epoch seconds) get the queue wait measured
+    if job.get('queued_at'):
+        metrics.stage_seconds.observe('queue wait', max(time.time() - float(job['queued_at']), 0))
 
-    while True:
-        job = rdb.brpop('hackpad_imports')
-        job_obj = json.loads(job[1].decode('utf-8'))
-        m = re.search('^.+attachments/(.+)\.zip$', job_obj['attachment'])
-        job_id = m.group(1)
-
-        # move job to temporary hash
-        rdb.hset('hackpad_processing', job_id, job[1])
-        
-        pool.spawn(import_pads, rdb, job_obj, job_id)
-
+    # Errors of this job go out as one digest mail when it is done
+    outbox.open_digest(job_id)
+    try:
+        # Create a new hackpad for each HTML file
+        logging.info("Starting job %s" % job_id)
+        worker_stats['jobs_started'] += 1
+        pads_created, pads_skipped = create_pads_from_files(job_state, job_id, job['attachment'], job['email_address'], account_id, client_id, client_secret)
+        worker_stats['pads_created'] += pads_created
+        worker_stats['pads_skipped'] += pads_skipped
+
+        # All is good: email the customer the job is done + credentials (in case it is a new account)
+        if pads_created + pads_skipped:
+            email_account(job['email_address'], new_account, account_id, pads_created, pads_skipped)
+            # move finished jobs to done queue
+            job_state.finish(job_id)
+            worker_stats['jobs_finished'] += 1
+        else:
+            email_error("No pads processed.", job_id)
+            job_state.fail(job_id)
+            worker_stats['jobs_failed'] += 1
+        logging.info("Images for job %s: %s" % (job_id, pop_image_stats(job_id)))
+        logging.info("Image cache: %s" % image_cache)
+        logging.info("MySQL pool: %s" % db_pool)
+        logging.info("Finished job %s" % job_id)
+    except Exception as err:
+        # like a missing or corrupt zip, running it again won't help
+        logging.exception("Job %s failed" % job_id)
+        email_error("Job failed: {}".format(err), job_id)
+        job_state.fail(job_id)
+        worker_stats['jobs_failed'] += 1
+    finally:
+        outbox.close_digest(job_id, 'hackpad@stek.io', 'errors@stek.io',
+                            '[Error] Hackpad migration errors for job: %s' % job_id)
 
 
-def import_pads(rdb, job, job_id):
-    """ Import the pads for one account """
-    # Open DB connection
-    db = mysql_connect()
     
-    # If email has no account for domain #1 yet, create one in the hackpad DB
-    account_id = get_account_id(db, job['email_address'])
-    new_account = False
-    if not account_id:
-        account_id = create_new_account(db, job_id, job['email_address'], job['from'])
-        new_account = True
-        if not account_id:
-            return None # stop spawned job
-        
-    # Get API token for account
-    client_secret = get_account_api_token(db, account_id, job_id)
-    if not client_secret:
-        return None # stop spawned job
-
-    # Get the API client_id for account
-    client_id = get_client_id(account_id, job_id)
-    if not client_id:
-        return None # stop spawned job
-    
-    # Create a new hackpad for each HTML file
-    logging.info("Starting job %s" % job_id)
-    pads_created, pads_skipped = create_pads_from_files(job_id, job['attachment'], job['email_address'], client_id, client_secret)
-
-    # All is good: email the customer the job is done + credentials (in case it is a new account)
-    if pads_created + pads_skipped:
-        email_account(job['email_address'], new_account, account_id, pads_created, pads_skipped)
-        # move finished jobs to done queue
-        done_job = rdb.hget('hackpad_processing', job_id)
-        rdb.hdel('hackpad_processing', job_id)
-        rdb.hset('hackpad_done', job_id, done_job)
-    else:
-        email_error("No pads processed.", job_id)
-    logging.info("Finished job %s" % job_id)
-
-    
-def get_account_id(db, email, domain_id=1):
-    """ Check if the current email is already a hackpad pro_accounts for the 
-    specified domain_id and return the account_id
+def provision_accounts(jobs, domain_id=1, token_type=4):
+    """ Make sure the email of every job has a hackpad pro_accounts for the specified
+    domain_id and an API token in pro_tokens, creating what is missing in a single
+    transaction. Return a dict of job_id -> (account_id, new_account, client_secret,
+    client_id) for the jobs that can be imported, or None if MySQL failed. Emails are
+    matched case insensitively, like the email column does.
     """
-    query = "SELECT id FROM pro_accounts WHERE email=%s AND domainId=%s"
-    r = mysql_select_one(db, query, (email, domain_id))
-    if r:
-        return r['id']
-    return None
-
-
-def create_new_account(db, job_id, email, the_from, domain_id=1):
-    """ Create a new hackpad pro_accounts with this email for the specified domain_id """
-    logging.info('Creating new account...')
+    # lowercased email -> email as the first job has it, which a new account gets
+    addresses = {}
+    for _, job in jobs:
+        addresses.setdefault(job['email_address'].lower(), job['email_address'])
+    emails = sorted(addresses)
+    logging.info('Provisioning %d accounts for %d jobs' % (len(emails), len(jobs)))
     try:
-        cursor = db.cursor()
-
-        full_name = from_to_name(the_from, email)
-        
-        query = """INSERT INTO pro_accounts (id, domainId, fullName, email, passwordHash, 
-        createdDate, lastLoginDate, isAdmin, tempPassHash, isDeleted, fbid, 
-        deletedDate) VALUES (NULL, %s, %s, %s,
-        NULL, NOW(), NOW(), 0, NULL, 0, NULL, NULL);"""
-        query_args = (domain_id, full_name, email)
-
-        cursor.execute(query, query_args)
-        db.commit()
+        with stage('mysql provisioning'), db_pool.connection() as db:
+            try:
+                # Existing accounts, then create the missing ones in one statement
+                account_ids = select_account_ids(db, emails, domain_id)
+                new_emails = [email for email in emails if email not in account_ids]
+                if new_emails:
+                    logging.info('Creating %d new accounts...' % len(new_emails))
+                    full_names = dict((job['email_address'].lower(), from_to_name(job['from'], job['email_address']))
+                                      for _, job in reversed(jobs))
+                    query = """INSERT INTO pro_accounts (id, domainId, fullName, email, passwordHash, 
+                    createdDate, lastLoginDate, isAdmin, tempPassHash, isDeleted, fbid, 
+                    deletedDate) VALUES """ + ', '.join(["""(NULL, ?, ?, ?,
+                    NULL, NOW(), NOW(), 0, NULL, 0, NULL, NULL)"""] * len(new_emails))
+                    query_args = []
+                    for email in new_emails:
+                        query_args += [domain_id, full_names[email], addresses[email]]
+                    prepared(db, query).execute(query, query_args)
+                    account_ids.update(select_account_ids(db, new_emails, domain_id))
+
+                # Existing tokens, then create the missing ones in one statement
+                tokens = select_tokens(db, list(account_ids.values()), token_type)
+                new_tokens = dict((account_id, generate_token()) for account_id in account_ids.values()
+                                  if account_id not in tokens)
+                if new_tokens:
+                    logging.info('Creating %d new tokens...' % len(new_tokens))
+                    query = """INSERT INTO pro_tokens (userId, tokenType, expirationDate, token, tokenExtra) 
+                    VALUES """ + ', '.join(['(?, ?, NULL, ?, NULL)'] * len(new_tokens))
+                    query_args = []
+                    for account_id, token in new_tokens.items():
+                        query_args += [account_id, token_type, token]
+                    prepared(db, query).execute(query, query_args)
+                    tokens.update(new_tokens)
+                db.commit()
+            except mysql.connector.Error:
+                db.rollback()
+                raise
     except mysql.connector.Error as err:
-        email_error("Failed inserting records to Hackpad: {}".format(err), job_id)
-        
-    return cursor.lastrowid
-
+        logging.error('Failed provisioning accounts and tokens for jobs %s, putting them back in the queue: %s' % (
+            ', '.join(job_id for job_id, _ in jobs), err))
+        return None
 
-def get_account_api_token(db, account_id, job_id, token_type=4):
-    """ Generate a hackpad API token and insert it in the pro_tokens table 
-    (if it doesn't exist yet) and return it.
+    accounts = {}
+    for job_id, job in jobs:
+        account_id = account_ids.get(job['email_address'].lower())
+        if not account_id:
+            email_error("Failed to create account for {}".format(job['email_address']), job_id)
+            continue
+        # Get the API client_id for account
+        try:
+            client_id = get_client_id(account_id, job_id)
+        except OSError as err:
+            # like a missing key file, fails only this job and not the worker
+            email_error("Failed to read the client_id of account {}: {}".format(account_id, err), job_id)
+            continue
+        if not client_id:
+            continue
+        accounts[job_id] = (account_id, job['email_address'].lower() in new_emails, tokens[account_id], client_id)
+    return accounts
+
+
+def select_account_ids(db, emails, domain_id):
+    """ Return a dict of lowercased email -> account_id for the emails that have a
+    pro_accounts for the specified domain_id
     """
-    query = "SELECT token FROM pro_tokens WHERE userId=%s AND tokenType=%s"
-    r = mysql_select_one(db, query, (account_id, token_type))
-    if r:
-        if isinstance(r['token'], bytearray): # this db field is binary
-            return r['token'].decode()        
-        return r['token']
-    
-    logging.info('Creating new token...')
-    try:
-        cursor = db.cursor()
+    query = "SELECT id, email FROM pro_accounts WHERE domainId=? AND email IN (%s)" % ', '.join(['?'] * len(emails))
+    account_ids = {}
+    for r in mysql_select_all(db, query, [domain_id] + list(emails)):
+        email = r['email'].decode() if isinstance(r['email'], (bytes, bytearray)) else r['email']
+        account_ids.setdefault(email.lower(), r['id'])
+    return account_ids
 
-        # Generate token: https://stackoverflow.com/a/23728630/562267
-        token = ''.join(random.SystemRandom().choice(string.ascii_letters + string.digits) for _ in range(32))
-        
-        query = """INSERT INTO pro_tokens (userId, tokenType, expirationDate, token, tokenExtra) 
-        VALUES (%s, %s, NULL, %s, NULL);"""
-        query_args = (account_id, token_type, token)
 
-        cursor.execute(query, query_args)
-        db.commit()
-    except mysql.connector.Error as err:
-        email_error("Failed inserting token to Hackpad: {}".format(err), job_id)
-        return False
-        
-    return token
+def select_tokens(db, account_ids, token_type):
+    """ Return a dict of account_id -> API token for the accounts that have one """
+    if not account_ids:
+        return {}
+    query = "SELECT userId, token FROM pro_tokens WHERE tokenType=? AND userId IN (%s)" % ', '.join(['?'] * len(account_ids))
+    tokens = {}
+    for r in mysql_select_all(db, query, [token_type] + list(account_ids)):
+        token = r['token']
+        if isinstance(token, (bytes, bytearray)): # this db field is binary
+            token = token.decode()
+        tokens.setdefault(r['userId'], token)
+    return tokens
+
+
+def generate_token():
+    """ Generate a hackpad API token: https://stackoverflow.com/a/23728630/562267 """
+    return ''.join(random.SystemRandom().choice(string.ascii_letters + string.digits) for _ in range(32))
 
 
 def get_client_id(account_id, job_id):
     """ Do a lookup to get the client_id for account with account_id """
     account_id_encryption_key = os.environ.get('HACKPAD_ACCOUNT_ID_KEY') or '0123456789abcdef' # default used for local testing
     client_ids_path = os.environ.get('HACKPAD_CLIENT_IDS_PATH') or './client_ids/' # default used for local testing
-    for line in open(client_ids_path + account_id_encryption_key, 'r'):
-        id, client_id = line.split(' ')
-        if str(account_id) == id:
-            return client_id.strip()
+    client_id = lookup_client_id(client_ids_path + account_id_encryption_key, account_id, run_blocking)
+    if client_id:
+        return client_id
     email_error("Failed to get client_id for account {}".format(account_id), job_id)
     return False
     
 
-def create_pads_from_files(job_id, attachment, email, client_id, client_secret):
+def create_pads_from_files(job_state, job_id, attachment, email, account_id, client_id, client_secret):
     """ For each HTML file in zipped attachment, create a new pad, return the number of
-    created pads
+    created pads. Files a previous run of the job already imported are not imported again.
     """
     logging.info("Opening attached zip %s." % attachment)
-    m = re.search('^.+attachments/(.+)\.zip$', attachment)
-    directory = './data/' + m.group(1)
-    unzip_attachment(attachment, directory)
-    files = os.listdir(directory)
+    stream = HACKPAD_INGEST_MODE != 'extract'
+    if stream:
+        files, sizes, skipped = run_blocking('unzip', zip_pad_members, attachment)
+        for member_name in skipped:
+            logging.info('Skipping non html member for job %s: %s' % (job_id, member_name))
+    else:
+        m = re.search('^.+attachments/(.+)\.zip$', attachment)
+        directory = './data/' + m.group(1)
+        run_blocking('unzip', unzip_attachment, attachment, directory)
+        files = os.listdir(directory)
     
-    hackpad = Hackpad(api_scheme = os.getenv('HACKPAD_API_SCHEME') or 'http',
-                      api_domain = os.getenv('HACKPAD_API_DOMAIN') or 'hackpad.dev',
-                      sub_domain = os.getenv('HACKPAD_SUB_DOMAIN') or '',
-                      consumer_key = client_id,
-                      consumer_secret = client_secret)
-
-    pads_created = pads_skipped = 0
+    # the API client and its connections are shared by all jobs, requests are signed per account
+    hackpad = hackpad_api(api_scheme = os.getenv('HACKPAD_API_SCHEME') or 'http',
+                          api_domain = os.getenv('HACKPAD_API_DOMAIN') or 'hackpad.dev',
+                          sub_domain = os.getenv('HACKPAD_SUB_DOMAIN') or '').account(client_id, client_secret)
+
+    done = job_state.progress(job_id)
+    if done:
+        logging.info('Resuming job %s, %d files already done' % (job_id, len(done)))
+
+    def import_file(file):
+        """ Import one file, return True if a pad was created, False if skipped and
+        None if it is not a pad
+        """
+        if file in done:
+            return bool(done[file])
+
+        with stage('pad slot wait'):
+            pad_slots.acquire()
+        try:
+            # wait for the memory to hold the pad, the biggest pads have the budget to themselves
+            file_size = sizes[file] if stream else os.path.getsize(directory + '/' + file)
+            with stage('memory wait'):
+                reservation = pad_budget.acquire(file_size * PAD_MEMORY_FACTOR)
+            try:
+                return import_pad(file, os.path.basename(file) if stream else file)
+            finally:
+                pad_budget.release(reservation)
+        finally:
+            pad_slots.release()
+
+    def import_pad(file, file_name):
+        """ Read and import a file, in the pad slot and memory reserved for it """
+        # check if it is really an html file and read it, in the threadpool
+        if stream:
+            file_type, html_pad, pad_fingerprint = run_blocking('read pad', read_zip_pad, attachment, file)
+        else:
+            file_type, html_pad, pad_fingerprint = run_blocking('read pad', read_pad_file, directory + '/' + file_name)
 
-    for file_name in files:
-        file_path = directory + '/' + file_name
-        # check if it is really an html file
-        file_type = magic.from_file(file_path, mime=True)
         if file_type != 'text/html':
-            logging.info('Invalid file type for file %s :%s' % (file_path, file_type))
-            continue 
-        
-        fh = open(file_path)
+            logging.info('Invalid file type for file %s :%s' % (file_name, file_type))
+            metrics.pads.inc('not a pad')
+            return None
 
         logging.info('importing for %s: %s' % (email, file_name))
-        
-        if insert_pad_from_file(job_id, hackpad, fh, file_name, client_id, client_secret):
+        metrics.bytes_processed.inc('pad html', len(html_pad))
+
+        pad_id = insert_pad_from_file(job_id, hackpad, html_pad, file_name, client_id, client_secret,
+                                      account_id, pad_fingerprint)
+        if pad_id is not None:
+            job_state.record(job_id, file, pad_id)
+        if pad_id:
+            metrics.pads.inc('created')
+            metrics.pads_created.mark()
+        else:
+            metrics.pads.inc('failed' if pad_id is None else 'skipped')
+        return bool(pad_id)
+
+    pad_pool = Pool(HACKPAD_PAD_CONCURRENCY)
+    greenlets = [pad_pool.spawn(import_file, file_name) for file_name in files]
+    gevent.joinall(greenlets)
+
+    pads_created = pads_skipped = 0
+    for greenlet in greenlets:
+        if not greenlet.successful() or greenlet.value is None:
+            continue # not processed
+        if greenlet.value:
             pads_created += 1
         else:
             pads_skipped += 1
-        fh.close()
     # Check if all files are imported
     if pads_created + pads_skipped != len(files):
         email_error("Not all files were processed", job_id)
@@ -233,29 +487,28 @@ def create_pads_from_files(job_id, attachment, email, client_id, client_secret):
     return pads_created, pads_skipped
 
 
-def insert_pad_from_file(job_id, hackpad, fh, file_name, client_id, client_secret):
-    """ Check the file contents, and create a pad via the hackpad API """
-    html_pad = fh.read().replace('\n', '')
-    if html_pad == '<body><h1>Untitled</h1><p></p><p>This pad text is synchronized as you type, so that everyone viewing this page sees the same text.&nbsp; This allows you to collaborate seamlessly on documents!</p><p></p><p></p></body>':
+def insert_pad_from_file(job_id, hackpad, html_pad, file_name, client_id, client_secret, account_id, pad_fingerprint):
+    """ Check the (newline free) file contents, and create a pad via the hackpad API.
+    Return the globalPadId of the new pad, False if the file is skipped or None if it failed.
+    """
+    if pad_fingerprint in BOILERPLATE:
         return False # default pad
-    html_pad = re.sub(r'^.*?<body', '<html><body', html_pad) # remove all stuff before first <body> tag
-
-    # Fix html export file bug
-    html_pad = fix_invalid_a_tag(html_pad)
+    # the same pad from an earlier export of the account
+    pad_id = pad_index.lookup(account_id, pad_fingerprint)
+    if pad_id:
+        logging.info('Skipping %s, it was imported before as %s' % (file_name, pad_id))
+        metrics.pads.inc('duplicate')
+        return False
 
-    # Images won't show-up if they don't have some class/properties
-    html_pad = fix_img_tag(html_pad)
-    
-    # If file contains images, copy the images to our own S3 repo
-    if 'https://hackpad-attachments.s3.amazonaws.com/' in html_pad:
-        html_pad = replace_image(job_id, file_name, html_pad, 'stekpad-prod')
-    
-    # get the title
-    m = re.search('<h1.*?>(.+?)</h1>', html_pad)
-    if m:
-        title = re.sub('<[^<]+?>', '', m.group(1)) # strip html tags
-        title = html.unescape(title).strip() # remove html encoded chars and whitespace around string
-    else:
+    # Fix the export bugs in the threadpool, copy the images to our own S3 repo and get the title
+    scanned = run_blocking('html rewrite', scan_pad, html_pad)
+    new_urls = None
+    if scanned.urls:
+        with stage('images'):
+            new_urls = upload_images(job_id, file_name, list(scanned.urls), 'stekpad-prod')
+    with stage('html render'):
+        html_pad, title = scanned.render(new_urls)
+    if title is None:
         # use the filename as the title
         title = file_name.replace('-', ' ').rstrip('.html').strip()
         
@@ -263,13 +516,15 @@ def insert_pad_from_file(job_id, hackpad, fh, file_name, client_id, client_secre
         logging.info('Fake create, sleeping for %s seconds...' % EMULATE_INSERTS_DELAY)
         time.sleep(EMULATE_INSERTS_DELAY)
     else: # real insert
-        new_pad = hackpad.create_hackpad(title, html_pad, '', 'text/html')
+        with stage('create pad'):
+            new_pad = hackpad.create_hackpad(title, html_pad, '', 'text/html')
         if new_pad and 'globalPadId' in new_pad:
             logging.info('Created pad: %s' % new_pad['globalPadId'])
-            return True
+            pad_index.add(account_id, pad_fingerprint, new_pad['globalPadId'])
+            return new_pad['globalPadId']
         else:
             email_error("Could not create pad %s" % file_name, job_id)
-            return False
+            return None
 
 
 def email_account(email, new_account, account_id, pads_created, pads_skipped):
@@ -293,18 +548,69 @@ The Stek Team
     send_text_email('hello@stek.io', email, 'Migration from hackpad.com completed', msg, bcc='hello@stek.io')
 
 
-def fix_invalid_a_tag(html_pad):
-    tags = re.findall('<a([^>]+)/>', html_pad)
-    for tag in tags:
-        html_pad = html_pad.replace('<a'+tag+'/>', '<a'+tag+'>')
-    return html_pad
+def zip_pad_members(attachment):
+    """ Return the names of the members of the zip that can be pads, a dict of their
+    uncompressed sizes, and the names of the ones that are skipped, judging by the central
+    directory only: directories and files without an html extension are skipped. Runs in
+    the threadpool.
+    """
+    members = []
+    sizes = {}
+    skipped = []
+    with zipfile.ZipFile(attachment, 'r') as zip_ref:
+        for info in zip_ref.infolist():
+            if info.filename.endswith('/'):
+                continue
+            if not info.filename.lower().endswith(('.html', '.htm')):
+                skipped.append(info.filename)
+                continue
+            members.append(info.filename)
+            sizes[info.filename] = info.file_size
+    return members, sizes, skipped
+
+
+def read_zip_pad(attachment, member_name):
+    """ Return the mime type of a zip member and, if it is html, its newline free contents
+    and their fingerprint. Runs in the threadpool, where every thread keeps its own handles
+    on the zips.
+    """
+    zips = getattr(_thread_state, 'zips', None)
+    if zips is None:
+        zips = _thread_state.zips = OrderedDict()
+    zip_ref = zips.get(attachment)
+    if zip_ref is None:
+        zip_ref = zips[attachment] = zipfile.ZipFile(attachment, 'r')
+        if len(zips) > 2:
+            zips.popitem(last=False)[1].close()
+    with zip_ref.open(member_name) as member:
+        # check the type without reading the whole member
+        with metrics.timed('mime sniff'):
+            file_type = thread_magic().from_buffer(member.peek(SNIFF_BYTES)[:SNIFF_BYTES])
+        if file_type != 'text/html':
+            return file_type, None, None
+        html_pad = io.TextIOWrapper(member).read().replace('\n', '')
+    return file_type, html_pad, fingerprint(html_pad)
+
+
+def read_pad_file(file_path):
+    """ Return the mime type of an extracted file and, if it is html, its newline free
+    contents and their fingerprint. Runs in the threadpool.
+    """
+    with metrics.timed('mime sniff'):
+        file_type = thread_magic().from_file(file_path)
+    if file_type != 'text/html':
+        return file_type, None, None
+    with open(file_path) as fh:
+        html_pad = fh.read().replace('\n', '')
+    return file_type, html_pad, fingerprint(html_pad)
 
 
-def fix_img_tag(html_pad):
-    tags = re.findall('<img ([^>]+)>', html_pad)
-    for tag in tags:
-        html_pad = html_pad.replace('<img '+tag+'>', '<img class="inline-img" faketext="*" contenteditable="false"'+tag+'>')
-    return html_pad
+def thread_magic():
+    """ libmagic handle of the current thread """
+    mime_magic = getattr(_thread_state, 'magic', None)
+    if mime_magic is None:
+        mime_magic = _thread_state.magic = magic.Magic(mime=True)
+    return mime_magic
 
 
 def unzip_attachment(zipped_attachment, target_dir):
@@ -316,6 +622,8 @@ def unzip_attachment(zipped_attachment, target_dir):
 
 def email_error(msg, job_id='unknown'):
     logging.error('Error for job %s: %s' % (job_id, msg))
+    if outbox.add_to_digest(job_id, msg):
+        return
     send_text_email('hackpad@stek.io', 'errors@stek.io', '[Error] Hackpad migration error for job: %s' % job_id, msg)
 
     
@@ -359,21 +667,45 @@ def mysql_connect():
     return conn
 
 
+# MySQL connections of this worker, shared by all its jobs
+db_pool = ConnectionPool(mysql_connect,
+                         max_size=int(os.environ.get('HACKPAD_MYSQL_POOL_SIZE') or 5),
+                         max_age=int(os.environ.get('HACKPAD_MYSQL_POOL_MAX_AGE') or 3600),
+                         ping_after=int(os.environ.get('HACKPAD_MYSQL_POOL_PING_AFTER') or 30))
+metrics.Gauge('hackpad_mysql_connections', 'MySQL connections of the pool by state',
+              lambda: {'in_use': db_pool.in_use, 'idle': len(db_pool._idle)}, label='state')
+metrics.Gauge('hackpad_image_cache', 'Image cache lookups by result, and entries', image_cache.counters,
+              label='counter')
+
+
 def mysql_select_one(conn, query, query_args=None):
     """
     Fetches the first record matching the given query
 
     :param conn: Mysql Connection
-    :param query: The SELECT query to run
+    :param query: The SELECT query to run, as a prepared statement
     :param query_args: Query arguments
     :return: Result
     """
-    # Return first row of result object
-    cursor = conn.cursor(dictionary=True)
+    # Return first row of result object as a dict
+    rows = mysql_select_all(conn, query, query_args)
+    if not rows:
+        return None
+    return rows[0]
+
+
+def mysql_select_all(conn, query, query_args=None):
+    """
+    Fetches all records matching the given query
+
+    :param conn: Mysql Connection
+    :param query: The SELECT query to run, as a prepared statement
+    :param query_args: Query arguments
+    :return: List of rows as dicts
+    """
+    cursor = prepared(conn, query)
     cursor.execute(query, query_args)
-    row = cursor.fetchone()
-    cursor.close()
-    return row
+    return [dict(zip(cursor.column_names, row)) for row in cursor.fetchall()]
 
 
 if __name__ == '__main__':
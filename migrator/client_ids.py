@@ -0,0 +1,194 @@
+"""
+Indexed lookup of hackpad API client_id's.
+
+The key file written by bin/generate_clientid_table.py has one "<account_id> <client_id>"
+line per account. Scanning it for every job gets slow once it holds millions of lines, so
+we compile it into a sorted table of fixed-width records next to the text file
+(<key file>.idx) and binary-search it through mmap. The index header records the size and
+mtime of the text file it was built from, so a stale index is rebuilt automatically.
+
+Building the index and scanning the key file take seconds on big files. The worker passes
+hub.run_blocking as blocking, so they run in the threadpool instead of on the hub. When
+the index can't be built or read (like in a read-only directory), lookups scan the key
+file until it changes.
+"""
+
+import os
+import mmap
+import struct
+import time
+from logger import logging
+
+INDEX_SUFFIX = '.idx'
+INDEX_MAGIC = b'HPCIDX01'
+# magic, source size, source mtime (ns), number of records, client_id width
+HEADER = struct.Struct('<8sQqII')
+ACCOUNT_ID = struct.Struct('<Q')
+
+# Seconds between stat() calls on the key file to see if it changed
+CHECK_INTERVAL = float(os.environ.get('HACKPAD_CLIENT_IDS_CHECK_INTERVAL') or 1)
+
+
+def parse_key_file(text_path):
+    """ Read the key file and return a dict of account_id -> client_id. The first
+    line for an account wins, like the old linear scan did.
+    """
+    client_ids = {}
+    with open(text_path, 'rb') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) != 2 or not parts[0].isdigit():
+                continue
+            client_ids.setdefault(int(parts[0]), parts[1])
+    return client_ids
+
+
+def build_index(text_path, index_path=None, client_ids=None):
+    """ Compile the key file into a sorted fixed-width index and return its number of
+    records. The index is written to a temporary file and renamed, so readers never see a
+    half written index. Doesn't log, so it can run in the threadpool.
+    """
+    index_path = index_path or text_path + INDEX_SUFFIX
+    st = os.stat(text_path)
+    if client_ids is None:
+        client_ids = parse_key_file(text_path)
+    width = max((len(c) for c in client_ids.values()), default=0)
+
+    tmp_path = '%s.tmp.%d' % (index_path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(HEADER.pack(INDEX_MAGIC, st.st_size, st.st_mtime_ns, len(client_ids), width))
+            for account_id in sorted(client_ids):
+                f.write(ACCOUNT_ID.pack(account_id))
+                f.write(client_ids[account_id].ljust(width, b'\0'))
+        os.replace(tmp_path, index_path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return len(client_ids)
+
+
+def scan_key_file(text_path, account_id):
+    """ Linear scan of the key file, used when the index has no record for an account """
+    account_id = str(account_id)
+    with open(text_path, 'r') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 2 and parts[0] == account_id:
+                return parts[1]
+    return None
+
+
+class ClientIdIndex(object):
+    """ In-process cache of one key file's index. The index is (re)loaded only when the
+    size or mtime of the key file changes.
+    """
+
+    def __init__(self, text_path, index_path=None, blocking=None):
+        """ blocking(name, func, *args) runs the slow calls, they are called directly without it """
+        self.text_path = text_path
+        self.index_path = index_path or text_path + INDEX_SUFFIX
+        self._blocking = blocking or (lambda name, func, *args: func(*args))
+        self._building = False
+        self._signature = None
+        self._failed = None # signature of the key file the index could not be made for
+        self._checked_at = 0
+        self._mmap = None
+        self._count = 0
+        self._width = 0
+        self._record_size = ACCOUNT_ID.size
+
+    def lookup(self, account_id):
+        """ Return the client_id for account_id, or None if it is unknown """
+        self._refresh()
+        client_id = self._search(int(account_id))
+        if client_id is None:
+            # the key file may have grown since we last looked at it
+            client_id = self._blocking('client id scan', scan_key_file, self.text_path, account_id)
+        return client_id
+
+    def _refresh(self):
+        if self._building:
+            # another lookup is rebuilding the index, use the current one until then
+            return
+        now = time.monotonic()
+        if self._mmap is not None and now - self._checked_at < CHECK_INTERVAL:
+            return
+        self._checked_at = now
+        st = os.stat(self.text_path)
+        signature = (st.st_size, st.st_mtime_ns)
+        if signature in (self._signature, self._failed):
+            return
+        try:
+            if self._index_signature() != signature:
+                self._building = True
+                try:
+                    count = self._blocking('client id index', build_index, self.text_path, self.index_path)
+                finally:
+                    self._building = False
+                logging.info('Built client_id index %s with %d records' % (self.index_path, count))
+            self._load()
+        except OSError as err:
+            # the current index, if any, stays in use, misses are scanned
+            logging.error('Could not use client_id index %s, scanning %s instead: %s' % (
+                self.index_path, self.text_path, err))
+            self._failed = signature
+            return
+        self._signature = signature
+
+    def _index_signature(self):
+        try:
+            with open(self.index_path, 'rb') as f:
+                header = f.read(HEADER.size)
+        except FileNotFoundError:
+            return None
+        if len(header) != HEADER.size:
+            return None
+        magic, size, mtime_ns, _, _ = HEADER.unpack(header)
+        if magic != INDEX_MAGIC:
+            return None
+        return (size, mtime_ns)
+
+    def _load(self):
+        self.close()
+        with open(self.index_path, 'rb') as f:
+            _, _, _, self._count, self._width = HEADER.unpack(f.read(HEADER.size))
+            if self._count:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._record_size = ACCOUNT_ID.size + self._width
+
+    def _search(self, account_id):
+        if self._mmap is None:
+            return None
+        buf, lo, hi = self._mmap, 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = HEADER.size + mid * self._record_size
+            current = ACCOUNT_ID.unpack_from(buf, offset)[0]
+            if current < account_id:
+                lo = mid + 1
+            elif current > account_id:
+                hi = mid
+            else:
+                offset += ACCOUNT_ID.size
+                return buf[offset:offset + self._width].rstrip(b'\0').decode('utf-8')
+        return None
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+
+_indexes = {}
+
+
+def lookup_client_id(text_path, account_id, blocking=None):
+    """ Look up the client_id for account_id in the key file at text_path, see
+    ClientIdIndex for blocking
+    """
+    index = _indexes.get(text_path)
+    if index is None:
+        index = _indexes[text_path] = ClientIdIndex(text_path, blocking=blocking)
+    return index.lookup(account_id)
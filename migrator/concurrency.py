@@ -0,0 +1,150 @@
+"""
+Adaptive number of jobs a worker runs at the same time.
+
+Every HACKPAD_CONCURRENCY_INTERVAL seconds the controller compares the average latency
+of the downstream stages (Hackpad API, S3, MySQL) over the interval with the lowest it
+has seen, and counts the pads that failed. When a stage got HACKPAD_CONCURRENCY_SLOWDOWN
+times slower or too many pads failed, the limit is multiplied by
+HACKPAD_CONCURRENCY_DECREASE. Otherwise, when jobs are waiting in hackpad_imports and
+every slot is busy, it goes up by one. The limit starts at HACKPAD_INITIAL_CONCURRENT_JOBS
+(the minimum by default) and stays between HACKPAD_MIN_CONCURRENT_JOBS and
+HACKPAD_MAX_CONCURRENT_JOBS, so the maximum is a ceiling that can be set high.
+
+Operators pin the limit by setting hackpad_concurrency_pin:<worker id> (one worker) or
+hackpad_concurrency_pin (all workers) in Redis, at most HACKPAD_MAX_CONCURRENT_JOBS, and
+unpin by deleting the key.
+"""
+
+import os
+import gevent
+from logger import logging
+import metrics
+
+MIN_CONCURRENT_JOBS = int(os.environ.get('HACKPAD_MIN_CONCURRENT_JOBS') or 1)
+INITIAL_CONCURRENT_JOBS = int(os.environ.get('HACKPAD_INITIAL_CONCURRENT_JOBS') or 0) or None
+CONCURRENCY_INTERVAL = float(os.environ.get('HACKPAD_CONCURRENCY_INTERVAL') or 30)
+# How many times slower than its best a stage may get before the limit is lowered
+CONCURRENCY_SLOWDOWN = float(os.environ.get('HACKPAD_CONCURRENCY_SLOWDOWN') or 2)
+# Share of the pads that may fail before the limit is lowered
+CONCURRENCY_MAX_ERRORS = float(os.environ.get('HACKPAD_CONCURRENCY_MAX_ERRORS') or 0.1)
+CONCURRENCY_DECREASE = float(os.environ.get('HACKPAD_CONCURRENCY_DECREASE') or 0.5)
+# Observations a stage needs in an interval before its latency counts
+MIN_SAMPLES = 5
+# Weight of the latency of an interval in the best latency, so it can go up again
+BASELINE_DRIFT = 0.05
+
+DOWNSTREAM_STAGES = ('create pad', 's3 head', 's3 put', 'image download', 'mysql provisioning')
+PIN_KEY = 'hackpad_concurrency_pin'
+QUEUE = 'hackpad_imports'
+
+
+def pin_key(worker_id):
+    return '%s:%s' % (PIN_KEY, worker_id)
+
+
+class ConcurrencyController(object):
+
+    def __init__(self, rdb, scheduler, worker_id, minimum=MIN_CONCURRENT_JOBS, maximum=None,
+                 initial=INITIAL_CONCURRENT_JOBS):
+        """ maximum defaults to the slots of the scheduler, initial to the minimum """
+        self.rdb = rdb
+        self.scheduler = scheduler
+        self.worker_id = worker_id
+        self.maximum = maximum or scheduler.slots
+        self.minimum = max(min(minimum, self.maximum), 1)
+        self.limit = min(max(initial or self.minimum, self.minimum), self.maximum)
+        scheduler.resize(self.limit)
+        self.pinned = None
+        self._baselines = {}
+        self._totals = self._stage_totals()
+        self._pads = self._pad_totals()
+        metrics.Gauge('hackpad_job_concurrency', 'Jobs the worker may run at the same time, and its bounds',
+                      lambda: {'limit': self.limit, 'min': self.minimum, 'max': self.maximum,
+                               'pinned': self.pinned or 0},
+                      label='value')
+
+    def start(self):
+        return gevent.spawn(self._run)
+
+    def _run(self):
+        while True:
+            gevent.sleep(CONCURRENCY_INTERVAL)
+            try:
+                self.adjust()
+            except Exception as err:
+                logging.error('Could not adjust the job concurrency: %s' % err)
+
+    def adjust(self):
+        """ Decide the limit for the next interval and apply it """
+        slow = self._slow_stages()
+        failed, created = self._failed_pads()
+        pinned = self._read_pin()
+        if pinned is not None:
+            limit, reason = pinned, 'pinned in Redis'
+        elif self.pinned is not None:
+            limit, reason = self.limit, 'unpinned'
+        elif slow:
+            limit = int(self.limit * CONCURRENCY_DECREASE)
+            reason = 'slow %s' % ', '.join('%s %.2fs (best %.2fs)' % stage for stage in slow)
+        elif failed and failed > CONCURRENCY_MAX_ERRORS * (failed + created):
+            limit = int(self.limit * CONCURRENCY_DECREASE)
+            reason = '%d of %d pads failed' % (failed, failed + created)
+        else:
+            backlog = self.rdb.llen(QUEUE)
+            running = sum(self.scheduler.running.values())
+            if not backlog or running < self.limit:
+                limit, reason = self.limit, None
+            else:
+                limit = self.limit + 1
+                reason = '%d jobs queued and all %d slots busy' % (backlog, running)
+        if pinned is None:
+            limit = min(max(limit, self.minimum), self.maximum)
+        if limit != self.limit or pinned != self.pinned:
+            logging.info('Job concurrency %d -> %d: %s' % (self.limit, limit, reason))
+        self.limit = limit
+        self.pinned = pinned
+        self.scheduler.resize(limit)
+
+    def _read_pin(self):
+        """ The pinned limit, capped to the maximum, or None """
+        values = self.rdb.mget([pin_key(self.worker_id), PIN_KEY])
+        for value in values:
+            if value is None:
+                continue
+            try:
+                return min(max(int(value), 1), self.maximum)
+            except ValueError:
+                logging.warning('Ignoring job concurrency pin %r, not a number' % value)
+        return None
+
+    def _slow_stages(self):
+        """ Return (stage, average, best average) of the stages that got slow in the interval """
+        totals = self._stage_totals()
+        slow = []
+        for name in DOWNSTREAM_STAGES:
+            count = totals[name][0] - self._totals[name][0]
+            if count < MIN_SAMPLES:
+                continue
+            average = (totals[name][1] - self._totals[name][1]) / count
+            baseline = self._baselines.get(name)
+            if baseline is not None and average > CONCURRENCY_SLOWDOWN * baseline:
+                slow.append((name, average, baseline))
+            if baseline is None or average < baseline:
+                self._baselines[name] = average
+            else:
+                self._baselines[name] = baseline + BASELINE_DRIFT * (average - baseline)
+        self._totals = totals
+        return slow
+
+    def _failed_pads(self):
+        """ Return the number of pads that failed and that were created in the interval """
+        pads = self._pad_totals()
+        failed, created = pads[0] - self._pads[0], pads[1] - self._pads[1]
+        self._pads = pads
+        return failed, created
+
+    def _stage_totals(self):
+        return dict((name, metrics.stage_seconds.totals(name)) for name in DOWNSTREAM_STAGES)
+
+    def _pad_totals(self):
+        return metrics.pads.value('failed'), metrics.pads.value('created')
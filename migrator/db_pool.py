@@ -0,0 +1,106 @@
+"""
+Connection pool for the hackpad MySQL database, shared by the greenlets of a worker.
+
+Connections are checked for health when they were idle for a while and recycled when
+they get old. Every connection keeps its prepared statements, so the provisioning
+queries are only prepared once per connection.
+"""
+
+import time
+from contextlib import contextmanager
+from gevent.lock import BoundedSemaphore
+from logger import logging
+
+
+class ConnectionPool(object):
+
+    def __init__(self, connect, max_size=5, max_age=3600, ping_after=30):
+        """ connect is called to open a new connection. Connections older than max_age
+        seconds are closed on return, connections idle for more than ping_after seconds
+        are pinged before they are handed out.
+        """
+        self._connect = connect
+        self.max_size = max_size
+        self.max_age = max_age
+        self.ping_after = ping_after
+        self._slots = BoundedSemaphore(max_size)
+        self._idle = [] # (connection, created, last used), most recently used last
+        self.in_use = 0
+        self.checkouts = 0
+        self.created = 0
+        self.recycled = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    @contextmanager
+    def connection(self):
+        """ Check out a connection for the duration of the with block """
+        start = time.monotonic()
+        self._slots.acquire()
+        waited = time.monotonic() - start
+        self.wait_seconds += waited
+        self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        self.checkouts += 1
+        self.in_use += 1
+        try:
+            conn, created = self._checkout()
+        except:
+            self.in_use -= 1
+            self._slots.release()
+            raise
+        try:
+            yield conn
+        except:
+            # the state of the connection is unknown, don't hand it out again
+            self._close(conn)
+            raise
+        else:
+            if time.monotonic() - created > self.max_age:
+                self.recycled += 1
+                self._close(conn)
+            else:
+                self._idle.append((conn, created, time.monotonic()))
+        finally:
+            self.in_use -= 1
+            self._slots.release()
+
+    def _checkout(self):
+        while self._idle:
+            conn, created, last_used = self._idle.pop()
+            if time.monotonic() - last_used < self.ping_after or self._healthy(conn):
+                return conn, created
+            self.recycled += 1
+            self._close(conn)
+        conn = self._connect()
+        self.created += 1
+        return conn, time.monotonic()
+
+    def _healthy(self, conn):
+        try:
+            conn.ping(reconnect=False)
+        except Exception as err:
+            logging.warning('Dropping MySQL connection that failed its health check: %s' % err)
+            return False
+        return True
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def __str__(self):
+        return '%d checkouts, %.3fs total wait, %.3fs max wait, %d in use, %d idle, %d created, %d recycled' % (
+            self.checkouts, self.wait_seconds, self.max_wait_seconds, self.in_use, len(self._idle),
+            self.created, self.recycled)
+
+
+def prepared(conn, query):
+    """ Return the prepared statement cursor for query on this connection """
+    statements = getattr(conn, 'hackpad_statements', None)
+    if statements is None:
+        statements = conn.hackpad_statements = {}
+    cursor = statements.get(query)
+    if cursor is None:
+        cursor = statements[query] = conn.cursor(prepared=True)
+    return cursor
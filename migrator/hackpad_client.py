@@ -0,0 +1,390 @@
+"""
+Client for the Hackpad API, shared by all jobs of a worker.
+
+There is one keep-alive session per API host. Requests are signed per account with
+OAuth1, like hackpad_api.hackpad.Hackpad does. Failures where the API certainly did not
+create the pad (connection errors, 429 and 503) are retried with jittered exponential
+backoff, honoring Retry-After. Others (500, timeouts while reading the response) are
+not, since creating a pad is not idempotent. A circuit breaker per host makes calls fail
+fast while the API keeps failing, so a degraded API doesn't tie up every pad slot.
+
+The API can be served by several app nodes, listed in HACKPAD_API_ENDPOINTS (like
+http://10.0.0.1:8080,http://10.0.0.2:8080). Requests are still signed for the site and
+sent with its Host (sub domain and domain) and scheme (X-Forwarded-Proto), so any node
+serves any account. Nodes reached over another scheme than the site must build the
+OAuth base string from X-Forwarded-Proto, like they do behind the load balancer. Each node
+has its own session, breaker and health: average latency, error rate and requests in
+flight. A request goes to the better of two random nodes, or to the node the account
+hashes to while that one is no more than HACKPAD_API_AFFINITY_SLACK times worse. Failed
+attempts are retried on another node. Nodes listed in the Redis set hackpad_api_drained
+only get requests when no other node can take them.
+"""
+
+import hashlib
+import os
+import random
+import time
+from email.utils import parsedate_tz, mktime_tz
+import gevent
+import requests
+from requests.compat import urlparse
+from requests.adapters import HTTPAdapter
+from requests_oauthlib import OAuth1
+from logger import logging
+import metrics
+
+API_CONNECT_TIMEOUT = float(os.environ.get('HACKPAD_API_CONNECT_TIMEOUT') or 5)
+API_READ_TIMEOUT = float(os.environ.get('HACKPAD_API_READ_TIMEOUT') or 60)
+API_POOL_SIZE = int(os.environ.get('HACKPAD_API_POOL_SIZE') or 32)
+API_RETRIES = int(os.environ.get('HACKPAD_API_RETRIES') or 4)
+# Base and cap in seconds of the exponential backoff between retries
+API_BACKOFF = float(os.environ.get('HACKPAD_API_BACKOFF') or 0.5)
+API_MAX_BACKOFF = float(os.environ.get('HACKPAD_API_MAX_BACKOFF') or 30)
+# Consecutive failures that open the breaker, and seconds before it lets a call through
+BREAKER_FAILURES = int(os.environ.get('HACKPAD_API_BREAKER_FAILURES') or 5)
+BREAKER_COOLDOWN = float(os.environ.get('HACKPAD_API_BREAKER_COOLDOWN') or 30)
+# App nodes serving the API, comma separated scheme://host[:port], the site itself if empty
+API_ENDPOINTS = [value.strip().rstrip('/') for value in (os.environ.get('HACKPAD_API_ENDPOINTS') or '').split(',')
+                 if value.strip()]
+# How many times worse than the best node the node of an account may be before its
+# requests go elsewhere, 0 to spread every account over all nodes
+API_AFFINITY_SLACK = float(os.environ.get('HACKPAD_API_AFFINITY_SLACK') or 2)
+# Share of the requests that go to a random node, so a node that was slow gets measured again
+API_EXPLORE = float(os.environ.get('HACKPAD_API_EXPLORE') or 0.05)
+# Seconds between reads of the set of drained nodes
+API_DRAINED_REFRESH = float(os.environ.get('HACKPAD_API_DRAINED_REFRESH') or 10)
+DRAINED_KEY = 'hackpad_api_drained'
+# Weight of the newest request in the average latency and error rate of a node
+HEALTH_WEIGHT = 0.2
+
+# Responses that mean the request was not processed
+RETRY_STATUSES = (429, 503)
+
+api_requests = metrics.Counter('hackpad_api_requests_total', 'Hackpad API requests by outcome', 'outcome')
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    """ Closed: calls go through. Open after failures consecutive failures: calls fail
+    until cooldown seconds passed. Then one trial call is let through (half open), which
+    closes the breaker when it succeeds and opens it again when it fails. A trial that
+    doesn't report back within cooldown seconds is replaced by a new one.
+    """
+
+    def __init__(self, failures=BREAKER_FAILURES, cooldown=BREAKER_COOLDOWN):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._trial_at = None
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return 'half open'
+        return 'open'
+
+    def allow(self):
+        """ Raise CircuitOpen if the call must not be made """
+        state = self.state
+        if state == 'open':
+            raise CircuitOpen()
+        if state == 'half open':
+            now = time.monotonic()
+            if self._trial_at is not None and now - self._trial_at < self.cooldown:
+                raise CircuitOpen()
+            self._trial_at = now
+
+    def success(self):
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._trial_at = None
+
+    def failure(self):
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.failures:
+            if self.opened_at is None:
+                logging.warning('Hackpad API failed %d times in a row, pausing calls for %ss' % (
+                    self.consecutive_failures, self.cooldown))
+            self.opened_at = time.monotonic()
+            self._trial_at = None
+
+
+class Backend(object):
+    """ One node serving the API, shared by the sites it serves """
+
+    def __init__(self, url):
+        self.url = url
+        self.session = requests.Session()
+        # retries are done here, where it is known which requests are safe to repeat
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=API_POOL_SIZE, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.breaker = CircuitBreaker()
+        self.latency = None
+        self.error_rate = 0.0
+        self.inflight = 0
+        self.drained = False
+
+    def available(self):
+        return self.breaker.state != 'open'
+
+    def score(self, default_latency):
+        """ Expected cost of a request, lower is better """
+        latency = self.latency if self.latency is not None else default_latency
+        return latency * (self.inflight + 1) / max(1 - self.error_rate, 0.05)
+
+    def observe(self, seconds, error):
+        if seconds is not None:
+            self.latency = seconds if self.latency is None else \
+                self.latency + HEALTH_WEIGHT * (seconds - self.latency)
+        self.error_rate += HEALTH_WEIGHT * ((1 if error else 0) - self.error_rate)
+
+
+class HackpadAPI(object):
+    """ The API of one site, served by one or more nodes """
+
+    def __init__(self, api_scheme='https', api_domain='hackpad.com', sub_domain=''):
+        self.site_url = '%s://%s%s' % (api_scheme, sub_domain + '.' if sub_domain else '', api_domain)
+        self.base_url = self.site_url + '/api/1.0/'
+        self.host = urlparse(self.site_url).netloc
+        self.scheme = api_scheme
+        self.backends = [backend(url) for url in API_ENDPOINTS or [self.site_url]]
+        for node in self.backends:
+            if urlparse(node.url).scheme != api_scheme:
+                logging.warning('Hackpad API node %s is not %s like %s, it must sign with X-Forwarded-Proto' % (
+                    node.url, api_scheme, self.site_url))
+
+    def account(self, client_id, client_secret):
+        """ The API as the account with these credentials """
+        return HackpadAccount(self, client_id, client_secret)
+
+    def request(self, method, path, client_id, client_secret, params=None, body='', content_type=None):
+        """ Make a signed API request, return the decoded JSON response or None if it failed """
+        query = {'client_id': client_id}
+        query.update(params or {})
+        headers = {'Content-Type': content_type} if content_type else {}
+        failed = None
+        for attempt in range(API_RETRIES + 1):
+            node = self.pick(client_id, avoid=failed)
+            if node is None:
+                api_requests.inc('circuit open')
+                logging.error('Hackpad API %s: not calling %s, too many failures' % (self.base_url, path))
+                return None
+            wait = None
+            failed = None
+            started = time.monotonic()
+            node.inflight += 1
+            try:
+                response = self.send(node, method, path, query, body, headers, client_id, client_secret)
+            except requests.exceptions.ConnectionError as err:
+                # not sent, unless the connection broke after it was established
+                if not is_connect_error(err):
+                    return self._failed(node, 'error', path, err)
+                node.breaker.failure()
+                node.observe(None, True)
+                failed = node
+                api_requests.inc('connect error')
+                logging.warning('Hackpad API %s: %s failed to connect to %s: %s' % (self.base_url, path, node.url, err))
+            except requests.exceptions.RequestException as err:
+                return self._failed(node, 'error', path, err)
+            else:
+                seconds = time.monotonic() - started
+                if response.status_code == 429:
+                    # the API is fine, we are going too fast
+                    node.breaker.success()
+                    node.observe(seconds, False)
+                    api_requests.inc('throttled')
+                    wait = retry_after(response) or backoff(attempt)
+                elif response.status_code in RETRY_STATUSES:
+                    node.breaker.failure()
+                    node.observe(seconds, True)
+                    failed = node
+                    api_requests.inc('unavailable')
+                    wait = retry_after(response)
+                elif response.status_code >= 500:
+                    return self._failed(node, 'server error', path, 'HTTP %d' % response.status_code)
+                else:
+                    node.breaker.success()
+                    node.observe(seconds, False)
+                    try:
+                        result = response.json()
+                    except ValueError:
+                        api_requests.inc('bad response')
+                        logging.error('Hackpad API %s: %s returned HTTP %d without JSON from %s' % (
+                            self.base_url, path, response.status_code, node.url))
+                        return None
+                    api_requests.inc('ok')
+                    return result
+            finally:
+                node.inflight -= 1
+            if attempt < API_RETRIES:
+                if failed is not None and self._alternative(failed):
+                    # another node can be tried right away
+                    wait = 0
+                elif wait is None:
+                    wait = backoff(attempt)
+                gevent.sleep(wait)
+        api_requests.inc('gave up')
+        logging.error('Hackpad API %s: %s still failing after %d retries' % (self.base_url, path, API_RETRIES))
+        return None
+
+    def send(self, node, method, path, query, body, headers, client_id, client_secret):
+        """ Sign the request for the site and send it to the node """
+        request = requests.Request(method, self.base_url + path, params=query, data=body.encode('utf-8'),
+                                   headers=headers, auth=OAuth1(client_id, client_secret=client_secret,
+                                                                signature_type='query'))
+        prepared = node.session.prepare_request(request)
+        if node.url != self.site_url:
+            url = urlparse(prepared.url)
+            prepared.url = node.url + prepared.url[len('%s://%s' % (url.scheme, url.netloc)):]
+            prepared.headers['Host'] = self.host
+            prepared.headers['X-Forwarded-Proto'] = self.scheme
+        settings = node.session.merge_environment_settings(prepared.url, {}, None, None, None)
+        return node.session.send(prepared, timeout=(API_CONNECT_TIMEOUT, API_READ_TIMEOUT), **settings)
+
+    def pick(self, affinity, avoid=None):
+        """ Return the node for the next attempt of a request of the account, or None if
+        every breaker is open. Drained nodes and the node that just failed are only used
+        when nothing else is left.
+        """
+        available = [node for node in self.backends if node.available()]
+        tiers = [[node for node in available if not node.drained and node is not avoid],
+                 [node for node in available if not node.drained],
+                 available]
+        for candidates in tiers:
+            while candidates:
+                node = self._choose(candidates, affinity)
+                try:
+                    node.breaker.allow()
+                except CircuitOpen:
+                    # its half open trial is taken
+                    candidates.remove(node)
+                    continue
+                return node
+        return None
+
+    def _choose(self, candidates, affinity):
+        if len(candidates) == 1:
+            return candidates[0]
+        if random.random() < API_EXPLORE:
+            return random.choice(candidates)
+        known = [node.latency for node in candidates if node.latency is not None]
+        default_latency = sum(known) / len(known) if known else 1.0
+        best = min(random.sample(candidates, 2), key=lambda node: node.score(default_latency))
+        if API_AFFINITY_SLACK:
+            preferred = max(candidates, key=lambda node: rendezvous(affinity, node.url))
+            if preferred.score(default_latency) <= API_AFFINITY_SLACK * best.score(default_latency):
+                return preferred
+        return best
+
+    def _alternative(self, failed):
+        return any(node is not failed and node.available() and not node.drained for node in self.backends)
+
+    def _failed(self, node, outcome, path, err):
+        node.breaker.failure()
+        node.observe(None, True)
+        api_requests.inc(outcome)
+        logging.error('Hackpad API %s: %s failed on %s, not retrying: %s' % (self.base_url, path, node.url, err))
+        return None
+
+
+class HackpadAccount(object):
+    """ Drop-in for hackpad_api.hackpad.Hackpad, for the calls the migrator makes """
+
+    def __init__(self, api, client_id, client_secret):
+        self.api = api
+        self.client_id = client_id
+        self.client_secret = client_secret
+
+    def create_hackpad(self, title, content, lastEditedTimestamp='', content_type='text/plain'):
+        params = {'lastEditedTimestamp': lastEditedTimestamp} if lastEditedTimestamp else {}
+        return self.api.request('POST', 'pad/create', self.client_id, self.client_secret, params,
+                                '%s\n%s' % (title, content), content_type)
+
+
+def is_connect_error(err):
+    """ True if err happened while connecting, so the request was never sent """
+    return isinstance(err, requests.exceptions.ConnectTimeout) or \
+        'NewConnectionError' in repr(err) or 'Connection refused' in str(err)
+
+
+def backoff(attempt):
+    """ Seconds to wait before retry attempt + 1, with full jitter """
+    return random.uniform(0, min(API_MAX_BACKOFF, API_BACKOFF * 2 ** attempt))
+
+
+def rendezvous(affinity, url):
+    """ Weight of a node for a key, the node with the highest weight is the key's node """
+    return hashlib.md5(('%s %s' % (affinity, url)).encode('utf-8')).digest()
+
+
+def retry_after(response):
+    """ Seconds to wait according to the Retry-After header, capped, or None """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        date = parsedate_tz(value)
+        if date is None:
+            return None
+        seconds = mktime_tz(date) - time.time()
+    return min(max(seconds, 0), API_MAX_BACKOFF)
+
+
+_apis = {}
+_backends = {}
+
+
+def backend(url):
+    """ The shared client of an API node """
+    node = _backends.get(url)
+    if node is None:
+        node = _backends[url] = Backend(url)
+    return node
+
+
+def hackpad_api(api_scheme='https', api_domain='hackpad.com', sub_domain=''):
+    """ The shared client of an API site """
+    key = (api_scheme, api_domain, sub_domain)
+    api = _apis.get(key)
+    if api is None:
+        api = _apis[key] = HackpadAPI(api_scheme, api_domain, sub_domain)
+    return api
+
+
+def watch_drained(rdb):
+    """ Keep the drained flags of the nodes in sync with the Redis set hackpad_api_drained """
+    def watch():
+        while True:
+            try:
+                drained = set(url.decode().rstrip('/') for url in rdb.smembers(DRAINED_KEY))
+            except Exception as err:
+                logging.warning('Could not read the drained API nodes: %s' % err)
+            else:
+                for node in list(_backends.values()):
+                    if node.drained != (node.url in drained):
+                        node.drained = node.url in drained
+                        logging.info('Hackpad API node %s %s' % (node.url, 'drained' if node.drained else 'back in use'))
+            gevent.sleep(API_DRAINED_REFRESH)
+    return gevent.spawn(watch)
+
+
+metrics.Gauge('hackpad_api_circuit_open', 'Whether the calls to an API node are paused',
+              lambda: dict((node.url, int(node.breaker.state == 'open')) for node in _backends.values()),
+              label='api')
+metrics.Gauge('hackpad_api_latency_seconds', 'Average latency of the API nodes',
+              lambda: dict((node.url, node.latency or 0) for node in _backends.values()), label='api')
+metrics.Gauge('hackpad_api_error_rate', 'Average share of failed requests of the API nodes',
+              lambda: dict((node.url, node.error_rate) for node in _backends.values()), label='api')
+metrics.Gauge('hackpad_api_inflight', 'Requests in flight per API node',
+              lambda: dict((node.url, node.inflight) for node in _backends.values()), label='api')
+metrics.Gauge('hackpad_api_drained', 'Whether an API node is drained',
+              lambda: dict((node.url, int(node.drained)) for node in _backends.values()), label='api')
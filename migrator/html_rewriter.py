@@ -0,0 +1,136 @@
+"""
+Single pass rewrite of exported hackpad HTML before it is sent to the API.
+
+One compiled regex walks the pad once and takes care of:
+- the <a .../> tags of the export that should be <a ...>
+- the class/properties <img> tags need to show up in the editor
+- collecting the hackpad-attachments src urls of all tags, which are rewritten through a
+  callback wherever they occur in the pad (like the links around the images)
+- finding the first <h1>, which is the title of the pad
+
+Unlike the old per-url search over the whole pad, only src=' attributes inside a tag are
+collected. An attachment url that appears solely as src='...' in the text of the pad
+(escaped html, say) is left as it is.
+"""
+
+import re
+import html
+
+ATTACHMENTS_URL = 'https://hackpad-attachments.s3.amazonaws.com/'
+IMG_ATTRIBUTES = '<img class="inline-img" faketext="*" contenteditable="false"'
+
+# Every token starts with '<', which keeps the scan for the next token fast
+TOKEN_RE = re.compile(r"<(?:a([^>]+)/>|img ([^>]+)>|h1|([^<>]*src='[^>]*))")
+SRC_RE = re.compile(r"src='([^']+)'")
+TITLE_RE = re.compile('<h1.*?>(.+?)</h1>')
+TAG_RE = re.compile('<[^<]+?>')
+
+
+class ScannedPad(object):
+    """ Pieces of the rewritten pad. Attachment urls are replaced once all urls of the
+    pad are known and resolved.
+    """
+
+    def __init__(self):
+        self.title_piece = None # index of the first <h1 in pieces
+        self.pieces = []
+        self.urls = {} # ordered set of the stripped attachment urls
+
+    def text(self, text):
+        self.pieces.append(text)
+
+    def src(self, value):
+        url = value.strip()
+        if url.startswith(ATTACHMENTS_URL):
+            self.urls[url] = None
+        self.pieces.append("src='" + value + "'")
+
+    def attributes(self, text):
+        """ Copy the inside of a tag, keeping track of the src attributes in it """
+        if "src='" not in text:
+            self.pieces.append(text)
+            return
+        pos = 0
+        for m in SRC_RE.finditer(text):
+            self.pieces.append(text[pos:m.start()])
+            self.src(m.group(1))
+            pos = m.end()
+        self.pieces.append(text[pos:])
+
+    def render(self, new_urls=None):
+        """ Fill in the new location of the attachment urls in new_urls (urls missing from
+        it are left alone) and return (html, title). The title is None when the pad has
+        no <h1>.
+        """
+        new_urls = dict((url, new_url) for url, new_url in (new_urls or {}).items() if new_url)
+        if new_urls:
+            # every occurrence, not only the src ones. Urls have no quotes, spaces or
+            # brackets, so none spans two pieces.
+            urls_re = re.compile('|'.join(re.escape(url) for url in sorted(new_urls, key=len, reverse=True)))
+            replace = lambda m: new_urls[m.group(0)]
+            self.pieces = [urls_re.sub(replace, piece) if ATTACHMENTS_URL in piece else piece
+                           for piece in self.pieces]
+
+        html_pad = ''.join(self.pieces)
+
+        title = None
+        if self.title_piece is not None:
+            offset = sum(len(piece) for piece in self.pieces[:self.title_piece])
+            m = TITLE_RE.search(html_pad, offset)
+            if m:
+                title = TAG_RE.sub('', m.group(1)) # strip html tags
+                title = html.unescape(title).strip() # remove html encoded chars and whitespace around string
+        return html_pad, title
+
+
+def rewrite_pad(html_pad, resolve_urls=None):
+    """ Rewrite the (newline free) HTML of a pad and return (html, title).
+
+    resolve_urls is called once with the list of attachment urls in the pad and
+    should return a dict that maps the urls to their new location. Urls missing
+    from the dict are left alone. The title is None when the pad has no <h1>.
+    """
+    out = scan_pad(html_pad)
+    new_urls = None
+    if out.urls and resolve_urls:
+        new_urls = resolve_urls(list(out.urls))
+    return out.render(new_urls)
+
+
+def scan_pad(html_pad):
+    """ Do the single pass over the (newline free) HTML of a pad. The attachment urls
+    found are in .urls of the returned ScannedPad, .render() gives the result.
+    """
+    out = ScannedPad()
+
+    # remove all stuff before first <body> tag
+    pos = html_pad.find('<body')
+    if pos == -1:
+        pos = 0
+    else:
+        out.text('<html>')
+
+    for m in TOKEN_RE.finditer(html_pad, pos):
+        out.text(html_pad[pos:m.start()])
+        a_tag, img_tag, tag = m.group(1, 2, 3)
+        if a_tag is not None:
+            # Fix html export file bug
+            out.text('<a')
+            out.attributes(a_tag)
+            out.text('>')
+        elif img_tag is not None:
+            # Images won't show-up if they don't have some class/properties
+            out.text(IMG_ATTRIBUTES)
+            out.attributes(img_tag)
+            out.text('>')
+        elif tag is not None:
+            # any other tag with a src attribute
+            out.text('<')
+            out.attributes(tag)
+        else:
+            if out.title_piece is None:
+                out.title_piece = len(out.pieces)
+            out.text('<h1')
+        pos = m.end()
+    out.text(html_pad[pos:])
+    return out
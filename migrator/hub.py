@@ -0,0 +1,112 @@
+"""
+Helpers to keep the gevent hub responsive.
+
+run_blocking runs CPU bound or blocking C calls (zip inflation, mime sniffing, PIL, the
+big regex passes) in the hub's threadpool, so the greenlets doing network I/O keep going.
+Code that runs in the threadpool must not use gevent (no greenlets, locks or sockets).
+
+The hub monitor is a native thread that watches greenlet switches. When one greenlet
+runs longer than the threshold without yielding, the stall is logged together with the
+stage the greenlet was in, as set with stage(). Stages also record their latency in the
+metrics.
+"""
+
+import os
+import sys
+import time
+import weakref
+from contextlib import contextmanager
+import greenlet
+import gevent
+from gevent import monkey
+from logger import logging
+import metrics
+
+# Seconds a greenlet may run without yielding before it is reported
+STALL_THRESHOLD = float(os.environ.get('HACKPAD_HUB_STALL_THRESHOLD') or 0.5)
+THREADPOOL_SIZE = int(os.environ.get('HACKPAD_THREADPOOL_SIZE') or 4)
+
+_stages = weakref.WeakKeyDictionary()
+
+
+@contextmanager
+def stage(name):
+    """ Mark the current greenlet as being in stage name for the duration of the block,
+    and record how long the block took
+    """
+    current = greenlet.getcurrent()
+    previous = _stages.get(current)
+    _stages[current] = name
+    try:
+        with metrics.timed(name):
+            yield
+    finally:
+        if previous is None:
+            _stages.pop(current, None)
+        else:
+            _stages[current] = previous
+
+
+def run_blocking(name, func, *args):
+    """ Run func(*args) in the threadpool as stage name and return its result """
+    with stage(name):
+        return gevent.get_hub().threadpool.apply(func, args)
+
+
+class HubMonitor(object):
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.stalls = 0
+        self._hub = gevent.get_hub()
+        self._running = None
+        self._since = time.monotonic()
+        self._reported = None
+        self._pending = []
+
+    def start(self):
+        """ Start watching the switches of the hub's thread """
+        self._hub.threadpool.maxsize = THREADPOOL_SIZE
+        metrics.Gauge('hackpad_hub_stalls_total', 'Times a greenlet kept the hub longer than %ss' % self.threshold,
+                      lambda: self.stalls, kind='counter')
+        metrics.Gauge('hackpad_threadpool_tasks', 'Tasks running or waiting in the threadpool',
+                      lambda: len(self._hub.threadpool))
+        greenlet.settrace(self._trace)
+        start_new_thread = monkey.get_original('_thread', 'start_new_thread')
+        start_new_thread(self._watch, ())
+        gevent.spawn(self._report)
+
+    def _trace(self, event, args):
+        if event in ('switch', 'throw'):
+            self._running = args[1]
+            self._since = time.monotonic()
+
+    def _watch(self):
+        # Native thread: it must not touch gevent or the (patched) logging locks
+        sleep = monkey.get_original('time', 'sleep')
+        while True:
+            sleep(self.threshold / 2)
+            running, since = self._running, self._since
+            if running is None or running is self._hub or self._reported is since:
+                continue
+            blocked = time.monotonic() - since
+            if blocked > self.threshold:
+                self._reported = since
+                stall = 'Hub blocked for more than %.2fs by %r in stage %s' % (
+                    blocked, running, _stages.get(running, 'unknown'))
+                self._pending.append(stall)
+                os.write(sys.stderr.fileno(), (stall + '\n').encode())
+
+    def _report(self):
+        """ Log the stalls the watcher found, from the hub """
+        while True:
+            gevent.sleep(1)
+            while self._pending:
+                self.stalls += 1
+                logging.warning(self._pending.pop(0))
+
+
+def start_monitor(threshold=STALL_THRESHOLD):
+    monitor = HubMonitor(threshold)
+    monitor.start()
+    return monitor
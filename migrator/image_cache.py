@@ -0,0 +1,66 @@
+"""
+Two level cache of the images that were already copied to our bucket.
+
+The first level is an in-process LRU of source url -> new url. The second level is a
+Redis set, shared by all workers, of the bucket keys that were uploaded. A hit on either
+means the image doesn't have to be downloaded, checked or uploaded again.
+"""
+
+import os
+from collections import OrderedDict
+
+REDIS_KEY = 'hackpad_uploaded_images'
+
+
+class ImageCache(object):
+
+    def __init__(self, max_entries, rdb=None):
+        self.max_entries = max_entries
+        self.rdb = rdb
+        self._urls = OrderedDict()
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def attach(self, rdb):
+        """ Use rdb for the shared level of the cache """
+        self.rdb = rdb
+
+    def get(self, image_src, bucket_key, new_url):
+        """ Return new_url if the image was uploaded before, otherwise None.
+        bucket_key identifies the uploaded image in the shared level.
+        """
+        url = self._urls.get(image_src)
+        if url is not None:
+            self._urls.move_to_end(image_src)
+            self.local_hits += 1
+            return url
+        if self.rdb is not None and self.rdb.sismember(REDIS_KEY, bucket_key):
+            self._remember(image_src, new_url)
+            self.shared_hits += 1
+            return new_url
+        self.misses += 1
+        return None
+
+    def add(self, image_src, bucket_key, new_url):
+        """ Record that the image is now in our bucket """
+        self._remember(image_src, new_url)
+        if self.rdb is not None:
+            self.rdb.sadd(REDIS_KEY, bucket_key)
+
+    def _remember(self, image_src, new_url):
+        self._urls[image_src] = new_url
+        self._urls.move_to_end(image_src)
+        while len(self._urls) > self.max_entries:
+            self._urls.popitem(last=False)
+
+    def counters(self):
+        return {'local_hits': self.local_hits, 'shared_hits': self.shared_hits, 'misses': self.misses,
+                'entries': len(self._urls)}
+
+    def __str__(self):
+        return '%(local_hits)d local hits, %(shared_hits)d shared hits, %(misses)d misses, ' \
+            '%(entries)d entries' % self.counters()
+
+
+image_cache = ImageCache(int(os.environ.get('HACKPAD_IMAGE_CACHE_SIZE') or 10000))
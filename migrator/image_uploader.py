@@ -1,105 +1,294 @@
+import os
 import boto3
 import botocore
-import mimetypes
 from datetime import datetime, timedelta
-import urllib.parse, urllib.request
+import urllib.parse
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from gevent.pool import Pool
 from PIL import Image
 import io
 import re
+import tempfile
+import time
 from logger import logging
+from image_cache import image_cache
+from hub import run_blocking, stage
+from memory_budget import image_budget
+import metrics
+
+# Number of images of one pad that are copied at the same time
+IMAGE_CONCURRENCY = int(os.environ.get('HACKPAD_IMAGE_CONCURRENCY') or 8)
+# Size of the keep-alive connection pools to hackpad-attachments and our bucket
+IMAGE_POOL_SIZE = int(os.environ.get('HACKPAD_IMAGE_POOL_SIZE') or 32)
+# Connect and read timeouts in seconds for every image request
+IMAGE_CONNECT_TIMEOUT = float(os.environ.get('HACKPAD_IMAGE_CONNECT_TIMEOUT') or 5)
+IMAGE_READ_TIMEOUT = float(os.environ.get('HACKPAD_IMAGE_READ_TIMEOUT') or 30)
+IMAGE_RETRIES = int(os.environ.get('HACKPAD_IMAGE_RETRIES') or 3)
+# Other endpoints for our bucket and for hackpad-attachments, like the stand-ins of
+# bin/bench_pipeline.py
+S3_ENDPOINT = os.environ.get('HACKPAD_S3_ENDPOINT') or None
+ATTACHMENTS_ENDPOINT = os.environ.get('HACKPAD_ATTACHMENTS_ENDPOINT') or None
+# Images are spooled to disk beyond this many bytes instead of held in memory
+IMAGE_SPILL_BYTES = int(os.environ.get('HACKPAD_IMAGE_SPILL_BYTES') or 8 * 1024 * 1024)
+# Bytes reserved for a download until its size is known
+IMAGE_DEFAULT_BYTES = 1024 * 1024
 
 boto3.setup_default_session(profile_name='stekpad')
-s3 = boto3.resource('s3', config=botocore.client.Config(signature_version='s3v4'))
+# Clients are safe to share between greenlets, resources aren't. botocore retries with
+# exponential backoff on its own.
+s3 = boto3.client('s3', endpoint_url=S3_ENDPOINT,
+                  config=botocore.client.Config(signature_version='s3v4',
+                                                max_pool_connections=IMAGE_POOL_SIZE,
+                                                connect_timeout=IMAGE_CONNECT_TIMEOUT,
+                                                read_timeout=IMAGE_READ_TIMEOUT))
+
+# Keep-alive session for downloading the hackpad attachments, retrying connection errors
+# and 5xx responses with backoff
+attachments = requests.Session()
+attachments.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=IMAGE_POOL_SIZE,
+                                          max_retries=Retry(total=IMAGE_RETRIES, backoff_factor=0.5,
+                                                            status_forcelist=(500, 502, 503, 504))))
+
+# Image formats browsers show as-is, by their magic bytes. These are uploaded unchanged,
+# anything else is converted to PNG.
+PASSTHROUGH_FORMATS = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+)
+
+
+class ImageStats(object):
+    """ Per job counts of the images that were passed through or transcoded """
+
+    def __init__(self):
+        self.passthrough_images = 0
+        self.passthrough_bytes = 0
+        self.transcoded_images = 0
+        self.transcoded_bytes = 0
+        self.transcode_seconds = 0.0
+
+    def cpu_saved(self):
+        """ Estimate of the CPU seconds the passed through images would have cost to
+        transcode, based on the transcodes measured in this process
+        """
+        if not process_stats.transcoded_bytes:
+            return None
+        return self.passthrough_bytes * process_stats.transcode_seconds / process_stats.transcoded_bytes
+
+    def __str__(self):
+        cpu_saved = self.cpu_saved()
+        return '%d images (%d bytes) passed through, %d images (%d bytes) transcoded in %.3fs CPU, ' \
+            'CPU saved: %s' % (self.passthrough_images, self.passthrough_bytes, self.transcoded_images,
+                               self.transcoded_bytes, self.transcode_seconds,
+                               '%.3fs' % cpu_saved if cpu_saved is not None else 'unknown')
+
+
+process_stats = ImageStats()
+job_stats = {}
+
+
+def pop_image_stats(job_id):
+    """ Return and forget the image stats of a job """
+    return job_stats.pop(job_id, None) or ImageStats()
+
+
+def sniff_image_type(data):
+    """ Return the mime type of an image that can be uploaded as-is, or None """
+    for magic_bytes, mime_type in PASSTHROUGH_FORMATS:
+        if data.startswith(magic_bytes):
+            return mime_type
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
 
 def replace_image(job_id, file_name, html_string, bucket_name, bucket_folder='content/'):
+    """ Copy the hackpad images in html_string to our bucket and point their src to the copy """
     # parse html and put it in a variable
-    images = set(re.findall("src='([^']+)'", html_string))
-    
+    images = set(image.strip() for image in re.findall("src='([^']+)'", html_string))
+    new_urls = upload_images(job_id, file_name, images, bucket_name, bucket_folder)
+    for image_src, new_url in new_urls.items():
+        # replace the src of the image with the new uploaded location
+        html_string = html_string.replace(image_src, new_url)
+    return html_string
+
+
+def upload_images(job_id, file_name, image_srcs, bucket_name, bucket_folder='content/'):
+    """ Upload the images in image_srcs to our bucket, return a dict of image_src -> new url
+    for the images that were copied
+    """
     logging.info("[IMG] Start analyzing html for job %s in file %s", job_id, file_name)
-    
-    # run loop for all images in the html
-    # Upload images in our bucket and replace image src
-    for image in images:
-        image_src = image.strip()
-
-        # if image was not uploaded to hackapad s3 ignore
-        if not image_src.startswith('https://hackpad-attachments.s3.amazonaws.com/'):
-            continue
-        
-        logging.info("[IMG] Processing image %s" % image_src)
-        
-        #get image mime_type
-        mime_type_info = mimetypes.guess_type(image_src)
-        mime_type = mime_type_info[0] if mime_type_info[0] else 'image/jpeg'
-
-        # construct expire and cache_control headers
-        days=100
-        cache_control = 'max-age= %d' % (60 * 60 * 24 * days)
-        expires = datetime.utcnow() + timedelta(days=days)
-        expires = expires.strftime("%a, %d %b %Y %H:%M:%S GMT")
 
+    stats = job_stats.setdefault(job_id, ImageStats())
+    # if image was not uploaded to hackapad s3 ignore
+    image_srcs = [image_src for image_src in image_srcs
+                  if image_src.startswith('https://hackpad-attachments.s3.amazonaws.com/')]
+
+    # Upload images in our bucket, a few at a time. imap keeps the order of image_srcs.
+    new_urls = {}
+    pool = Pool(IMAGE_CONCURRENCY)
+    results = pool.imap(lambda image_src: upload_image(image_src, bucket_name, bucket_folder, stats), image_srcs)
+    for image_src, new_url in zip(image_srcs, results):
+        if new_url:
+            logging.info("[IMG] Replace %s with %s" % (image_src, new_url))
+            new_urls[image_src] = new_url
+
+    logging.info("[IMG] Finished analyzing html for job %s in file %s", job_id, file_name)
+
+    return new_urls
+
+
+def upload_image(image_src, bucket_name, bucket_folder='content/', stats=None):
+    """ Copy one hackpad image to our bucket, return its new url or None on failure """
+    logging.info("[IMG] Processing image %s" % image_src)
+
+    # get image name
+    image_name = image_src.split('/')[-1]
+    key = bucket_folder + image_name
+    new_url = 'https://s3-eu-west-1.amazonaws.com/'+bucket_name+'/'+key
+
+    # Images that were copied before by any job need no download, check or upload
+    if image_cache.get(image_src, bucket_name + '/' + key, new_url):
+        logging.info("[IMG] Skipping upload: %s is cached" % image_src)
+        return new_url
+
+    # Check if it already exists in our bucket before downloading it
+    exists = False
+    try:
+        with stage('s3 head'):
+            s3.head_object(Bucket=bucket_name, Key=key)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == "404":
+            exists = False
+    else:
+        exists = True
+    if exists:
+        logging.info("[IMG] Skipping upload: %s already exists" % image_src)
+        image_cache.add(image_src, bucket_name + '/' + key, new_url)
+        return new_url
+
+    # construct expire and cache_control headers
+    days=100
+    cache_control = 'max-age= %d' % (60 * 60 * 24 * days)
+    expires = datetime.utcnow() + timedelta(days=days)
+    expires = expires.strftime("%a, %d %b %Y %H:%M:%S GMT")
+
+    # the image and its PNG version are spooled files, they reserve what they keep in memory
+    with image_budget.reserve(IMAGE_DEFAULT_BYTES) as reservation:
+        with stage('image download'):
+            data = download_image(image_src, reservation)
+        if data is None:
+            return None
+        body = None
         try:
-            logging.info("[IMG] First try for image %s", image_src)
-            # get image name
-            image_url_parts = image_src.split('/')
-            image_name = image_url_parts
-
-            # read image url
-            image_src_parsed = urllib.parse.urlparse(image_src)
-            image_name_encoded = urllib.parse.quote(image_src_parsed.path)            
-            file = io.BytesIO(urllib.request.urlopen(urllib.parse.urljoin(image_src, image_name_encoded)).read())
-            img = Image.open(file, mode='r')
-        except urllib.error.HTTPError as error:
-            logging.warning("[IMG] First try block resulted in urllib.error.HTTPError: %s" % error)
+            size = file_size(data)
+            metrics.bytes_processed.inc('image downloaded', size)
+
+            # Upload the original bytes of the formats browsers can show, only convert the others
+            mime_type = sniff_image_type(data.read(16))
+            data.seek(0)
+            if mime_type:
+                body = data
+                if stats:
+                    stats.passthrough_images += 1
+                    stats.passthrough_bytes += size
+            else:
+                try:
+                    # room for the decoded image next to the download
+                    pixels = run_blocking('image inspect', decoded_size, data)
+                    reservation.resize(min(size, IMAGE_SPILL_BYTES) + pixels)
+                    body, mime_type, seconds = run_blocking('image transcode', transcode_image, data)
+                except (IOError, ValueError) as error:
+                    logging.error("[IMG] Could not convert image %s: %s", image_src, error)
+                    return None
+                for image_stats in (stats, process_stats):
+                    if image_stats:
+                        image_stats.transcoded_images += 1
+                        image_stats.transcoded_bytes += size
+                        image_stats.transcode_seconds += seconds
+
+            # upload image to our bucket
+            logging.info("[IMG] Uploading %s" % image_src)
+            body_size = file_size(body)
             try:
-                logging.info("[IMG] retry for image %s", image_src)
-                file = io.BytesIO(urllib.request.urlopen(image_src).read())
-                img = Image.open(file, mode='r')
-            except urllib.error.HTTPError as error:
-                logging.error("[IMG] %s", error.read())
-                continue
-            except UnicodeEncodeError:
-                logging.error("[IMG] UnicodeEncodeError for image %s", image_src)
-                continue
-                
-
-        # get the image extension
-        image_parts = image_src_parsed.path.split('.')
-        image_extension = 'JPEG' if image_parts[-1].upper() == 'JPG' else image_parts[-1]
-        # hack for weird image URLs
-        if len(image_extension) > 4:
-            image_extension = 'png'
-        
-        # stream file in binary mode
-        imgByteArr = io.BytesIO()
-        img.save(imgByteArr, format=image_extension.upper())
-        imgByteArr = imgByteArr.getvalue()
-        
-        # upload image to our bucket
-        # First check if it already exists
-        exists = False
+                with stage('s3 put'):
+                    s3.put_object(Bucket=bucket_name, Key=key, Body=body, ACL='public-read', ContentType=mime_type, CacheControl=cache_control,Expires=expires)
+            except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as error:
+                logging.error("[IMG] Upload of %s failed: %s", image_src, error)
+                return None
+            metrics.bytes_processed.inc('image uploaded', body_size)
+        finally:
+            data.close()
+            if body is not None:
+                body.close()
+    image_cache.add(image_src, bucket_name + '/' + key, new_url)
+
+    return new_url
+
+
+def download_image(image_src, reservation):
+    """ Download an image from hackpad-attachments into a spooled file, return it or None on
+    failure. The reservation is resized to the part of the image that stays in memory.
+    """
+    # the url encoded path first, the url as-is if that is refused
+    image_src_parsed = urllib.parse.urlparse(image_src)
+    image_name_encoded = urllib.parse.quote(image_src_parsed.path)
+    urls = (urllib.parse.urljoin(image_src, image_name_encoded), image_src)
+    if ATTACHMENTS_ENDPOINT:
+        urls = tuple(ATTACHMENTS_ENDPOINT.rstrip('/') + '/' + url.split('/', 3)[3] for url in urls)
+    for attempt, url in enumerate(urls):
+        logging.info("[IMG] %s for image %s", 'First try' if not attempt else 'retry', image_src)
+        data = tempfile.SpooledTemporaryFile(max_size=IMAGE_SPILL_BYTES)
         try:
-            s3.Object(bucket_name, bucket_folder + image_name[-1]).load()
-        except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == "404":
-                exists = False
-        else:
-            exists = True
-        if exists:
-            logging.info("[IMG] Skipping upload: %s already exists" % image_src)
-        else:
-            logging.info("[IMG] Uploading %s" % image_src)
-            s3.Bucket(bucket_name).put_object(Key=bucket_folder+image_name[-1], Body=imgByteArr, ACL='public-read', ContentType=mime_type, CacheControl=cache_control,Expires=expires)
+            with attachments.get(url, timeout=(IMAGE_CONNECT_TIMEOUT, IMAGE_READ_TIMEOUT), stream=True) as response:
+                if not response.ok:
+                    logging.warning("[IMG] HTTP %s for %s: %s", response.status_code, url, response.text[:200])
+                    data.close()
+                    continue
+                length = response.headers.get('Content-Length')
+                if length and length.isdigit():
+                    reservation.resize(min(int(length), IMAGE_SPILL_BYTES))
+                for chunk in response.iter_content(64 * 1024):
+                    data.write(chunk)
+        except requests.exceptions.RequestException as error:
+            logging.error("[IMG] Download of %s failed: %s", image_src, error)
+            data.close()
+            return None
+        reservation.resize(min(file_size(data), IMAGE_SPILL_BYTES))
+        data.seek(0)
+        return data
+    return None
 
-        logging.info("[IMG] Replace %s with %s" % (image_src,'https://s3-eu-west-1.amazonaws.com/'+bucket_name+'/'+bucket_folder+image_name[-1]))
-        # replace the src of the image with the new uploaded location
-        html_string = html_string.replace(image_src, 'https://s3-eu-west-1.amazonaws.com/'+bucket_name+'/'+bucket_folder+image_name[-1])
 
-        logging.info("[IMG] Replaced with %s", image_src)
+def file_size(f):
+    """ Size of a file object, which is left at its start """
+    f.seek(0, io.SEEK_END)
+    size = f.tell()
+    f.seek(0)
+    return size
 
-    logging.info("[IMG] Finished analyzing html for job %s in file %s", job_id, file_name)
-        
-    return html_string
+
+def decoded_size(data):
+    """ Bytes the image in the file takes once decoded, from its header. Runs in the threadpool. """
+    img = Image.open(data)
+    width, height = img.size
+    data.seek(0)
+    return width * height * 4
+
+
+def transcode_image(data):
+    """ Convert the image in the file object data, which browsers can't show, to PNG.
+    Return (spooled file, mime type, CPU seconds). Runs in the threadpool.
+    """
+    start = time.thread_time()
+    img = Image.open(data, mode='r')
+    converted = tempfile.SpooledTemporaryFile(max_size=IMAGE_SPILL_BYTES)
+    img.save(converted, format='PNG')
+    converted.seek(0)
+    return converted, 'image/png', time.thread_time() - start
 
 
 if __name__ == '__main__':
@@ -0,0 +1,161 @@
+"""
+Job state in Redis: which worker owns a job, which pads of a job are done, and the
+transitions of a job between the hackpad_imports queue and the hackpad_processing,
+hackpad_done and hackpad_failed hashes.
+
+Every worker keeps a heartbeat key alive while it runs. Jobs in hackpad_processing whose
+owner has no heartbeat anymore are orphans of a crashed worker and are put back in the
+queue, by every worker at every heartbeat. The pads a job already created are recorded as they are created, so a resumed
+job skips them.
+"""
+
+import os
+import socket
+import gevent
+import redis
+from logger import logging
+
+PROCESSING = 'hackpad_processing'
+DONE = 'hackpad_done'
+# Jobs that can't be imported as they are, kept for an operator to put back in the queue
+FAILED = 'hackpad_failed'
+OWNERS = 'hackpad_processing_owner'
+QUEUE = 'hackpad_imports'
+
+# Seconds before the heartbeat of a dead worker expires
+WORKER_TTL = int(os.environ.get('HACKPAD_WORKER_TTL') or 60)
+
+# Marks a file in the progress hash that was skipped instead of created
+SKIPPED = b''
+
+
+def worker_key(worker_id):
+    return 'hackpad_worker:%s' % worker_id
+
+
+def stats_key(worker_id):
+    return 'hackpad_worker_stats:%s' % worker_id
+
+
+def progress_key(job_id):
+    return 'hackpad_progress:%s' % job_id
+
+
+# Move a job from processing to done and forget its state, in one step
+FINISH_JOB = """
+local job = redis.call('hget', KEYS[1], ARGV[1])
+if job then
+    redis.call('hset', KEYS[2], ARGV[1], job)
+    redis.call('hdel', KEYS[1], ARGV[1])
+end
+redis.call('hdel', KEYS[3], ARGV[1])
+redis.call('del', KEYS[4])
+return job and 1 or 0
+"""
+
+# Put the jobs of workers without a heartbeat back in the queue, except the ones of the
+# worker ARGV[2] itself. The progress of the jobs is kept, so they resume where they stopped.
+RECLAIM_JOBS = """
+local reclaimed = {}
+for _, job_id in ipairs(redis.call('hkeys', KEYS[1])) do
+    local owner = redis.call('hget', KEYS[2], job_id)
+    if not owner or (owner ~= ARGV[2] and redis.call('exists', ARGV[1] .. owner) == 0) then
+        redis.call('rpush', KEYS[3], redis.call('hget', KEYS[1], job_id))
+        redis.call('hdel', KEYS[1], job_id)
+        redis.call('hdel', KEYS[2], job_id)
+        table.insert(reclaimed, job_id)
+    end
+end
+return reclaimed
+"""
+
+
+class JobState(object):
+
+    def __init__(self, rdb, worker_id=None, stats=None):
+        """ stats is a dict of counters that is published with every heartbeat """
+        self.rdb = rdb
+        self.worker_id = worker_id or '%s:%d' % (socket.gethostname(), os.getpid())
+        self.stats = stats
+        self._finish_job = rdb.register_script(FINISH_JOB)
+        self._reclaim_jobs = rdb.register_script(RECLAIM_JOBS)
+        self._heartbeat = None
+
+    def start(self):
+        """ Reclaim the jobs of dead workers and start the heartbeat of this worker """
+        # a heartbeat under our id is from a previous process with the same host and pid,
+        # which left its jobs behind
+        self.rdb.delete(worker_key(self.worker_id))
+        reclaimed = self.reclaim(own=True)
+        self._publish()
+        self._heartbeat = gevent.spawn(self._beat)
+        return reclaimed
+
+    def reclaim(self, own=False):
+        """ Put the jobs of workers without a heartbeat back in the queue. With own, the
+        jobs under this worker's id are orphans too.
+        """
+        reclaimed = self._reclaim_jobs(keys=[PROCESSING, OWNERS, QUEUE],
+                                       args=[worker_key(''), '' if own else self.worker_id])
+        for job_id in reclaimed:
+            logging.warning('Reclaimed orphaned job %s' % job_id.decode())
+        return reclaimed
+
+    def stop(self):
+        if self._heartbeat is not None:
+            self._heartbeat.kill()
+        self._publish()
+        self.rdb.delete(worker_key(self.worker_id))
+
+    def _beat(self):
+        while True:
+            gevent.sleep(WORKER_TTL / 3)
+            try:
+                self._publish()
+                self.reclaim()
+            except redis.RedisError as err:
+                logging.warning('Heartbeat failed: %s' % err)
+
+    def _publish(self):
+        pipe = self.rdb.pipeline()
+        pipe.set(worker_key(self.worker_id), 1, ex=WORKER_TTL)
+        if self.stats:
+            pipe.hmset(stats_key(self.worker_id), self.stats)
+            pipe.expire(stats_key(self.worker_id), WORKER_TTL * 10)
+        pipe.execute()
+
+    def claim(self, jobs):
+        """ Move the (job_id, raw job) pairs popped from the queue to processing """
+        pipe = self.rdb.pipeline()
+        for job_id, raw_job in jobs:
+            pipe.hset(PROCESSING, job_id, raw_job)
+            pipe.hset(OWNERS, job_id, self.worker_id)
+        pipe.execute()
+
+    def release(self, jobs):
+        """ Put the claimed (job_id, raw job) pairs that did not start back in front of the queue """
+        pipe = self.rdb.pipeline()
+        for job_id, raw_job in jobs:
+            pipe.rpush(QUEUE, raw_job)
+            pipe.hdel(PROCESSING, job_id)
+            pipe.hdel(OWNERS, job_id)
+        pipe.execute()
+
+    def finish(self, job_id):
+        """ Move the job to done """
+        self._finish_job(keys=[PROCESSING, DONE, OWNERS, progress_key(job_id)], args=[job_id])
+
+    def fail(self, job_id):
+        """ Move the job to failed """
+        self._finish_job(keys=[PROCESSING, FAILED, OWNERS, progress_key(job_id)], args=[job_id])
+
+    def progress(self, job_id):
+        """ Return a dict of file name -> globalPadId (SKIPPED for skipped files) of the
+        files the job already imported
+        """
+        return dict((file_name.decode(), pad_id) for file_name, pad_id
+                    in self.rdb.hgetall(progress_key(job_id)).items())
+
+    def record(self, job_id, file_name, pad_id):
+        """ Record that file_name was imported as pad_id, or skipped when pad_id is falsy """
+        self.rdb.hset(progress_key(job_id), file_name, pad_id or SKIPPED)
@@ -1,3 +1,69 @@
+"""
+Logging setup of the migrator.
+
+Log records are put on an in-memory queue and written to a rotating log file by a
+native thread, so greenlets never wait for the disk. Workers of a fleet log to a file
+of their own, because rotation of a file shared by processes loses records.
+"""
+
+import atexit
 import logging
+import logging.handlers
+import os
+from gevent import monkey
+
+LOG_FILE = os.environ.get('HACKPAD_LOG_FILE') or 'migrator.log'
+LOG_LEVEL = os.environ.get('HACKPAD_LOG_LEVEL') or 'DEBUG'
+LOG_MAX_BYTES = int(os.environ.get('HACKPAD_LOG_MAX_BYTES') or 50 * 1024 * 1024)
+LOG_BACKUPS = int(os.environ.get('HACKPAD_LOG_BACKUPS') or 5)
+
+# Native versions, also when gevent patched the standard library
+SimpleQueue = monkey.get_original('queue', 'SimpleQueue')
+start_new_thread = monkey.get_original('_thread', 'start_new_thread')
+allocate_lock = monkey.get_original('_thread', 'allocate_lock')
+
+
+class LogWriter(object):
+    """ Writes the queued records to handler from a native thread """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.queue = SimpleQueue()
+        self._stopped = allocate_lock()
+
+    def start(self):
+        self._stopped.acquire()
+        start_new_thread(self._write, ())
+
+    def stop(self, timeout=5):
+        """ Write the records still queued and close the file """
+        self.queue.put(None)
+        if self._stopped.acquire(timeout=timeout):
+            self.handler.close()
+
+    def _write(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            try:
+                self.handler.handle(record)
+            except Exception:
+                self.handler.handleError(record)
+        self._stopped.release()
+
+
+def log_file():
+    worker_index = os.environ.get('HACKPAD_WORKER_INDEX')
+    if worker_index is None:
+        return LOG_FILE
+    base, ext = os.path.splitext(LOG_FILE)
+    return '%s.%s%s' % (base, worker_index, ext)
+
 
-logging.basicConfig(filename='migrator.log',level=logging.DEBUG)
+file_handler = logging.handlers.RotatingFileHandler(log_file(), maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS)
+writer = LogWriter(file_handler)
+writer.start()
+# the queue handler formats the records, the file handler writes them as they are
+logging.basicConfig(level=LOG_LEVEL, handlers=[logging.handlers.QueueHandler(writer.queue)])
+atexit.register(writer.stop)
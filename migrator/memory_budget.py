@@ -0,0 +1,109 @@
+"""
+Process-wide memory budget for the data that is in flight.
+
+Stages reserve the bytes they are about to load and wait (not fail) while the budget is
+used up, so raising the concurrency makes work wait instead of getting the worker
+OOM-killed. HACKPAD_MEMORY_BUDGET is split between pads and images. A pad's images come
+from the image share, so pads waiting for their images never hold up the images. A
+reservation that has to grow gives back what it holds before it waits. Requests bigger
+than a share are capped to the share, so they wait until they run alone.
+"""
+
+import os
+from collections import deque
+from contextlib import contextmanager
+from gevent.event import Event
+import metrics
+
+MEMORY_BUDGET = int(os.environ.get('HACKPAD_MEMORY_BUDGET') or 1024 * 1024 * 1024)
+# Share of the budget for the pads, the rest is for the images
+PAD_SHARE = float(os.environ.get('HACKPAD_MEMORY_PAD_SHARE') or 0.5)
+
+
+class MemoryBudget(object):
+
+    def __init__(self, name, capacity):
+        self.name = name
+        self.capacity = max(int(capacity), 1)
+        self.reserved = 0
+        self.peak = 0
+        self.waits = 0
+        self._waiters = deque() # [bytes, Event], first come first served
+
+    def acquire(self, size):
+        """ Reserve size bytes, waiting until they are available. Return the reserved size,
+        which is capped to the capacity.
+        """
+        size = min(max(int(size), 0), self.capacity)
+        if not self._waiters and self.reserved + size <= self.capacity:
+            self._take(size)
+            return size
+        waiter = [size, Event()]
+        self._waiters.append(waiter)
+        self.waits += 1
+        try:
+            waiter[1].wait()
+        except:
+            if waiter[1].is_set():
+                self.release(size)
+            else:
+                self._waiters.remove(waiter)
+                self._wake()
+            raise
+        return size
+
+    def release(self, size):
+        self.reserved -= size
+        self._wake()
+
+    @contextmanager
+    def reserve(self, size):
+        """ Hold a reservation of size bytes for the with block. The block gets a
+        Reservation it can resize.
+        """
+        reservation = Reservation(self, self.acquire(size))
+        try:
+            yield reservation
+        finally:
+            self.release(reservation.size)
+
+    def _take(self, size):
+        self.reserved += size
+        self.peak = max(self.peak, self.reserved)
+
+    def _wake(self):
+        while self._waiters and self.reserved + self._waiters[0][0] <= self.capacity:
+            size, event = self._waiters.popleft()
+            self._take(size)
+            event.set()
+
+    def counters(self):
+        return {'%s reserved' % self.name: self.reserved, '%s peak' % self.name: self.peak,
+                '%s capacity' % self.name: self.capacity, '%s waiting' % self.name: len(self._waiters)}
+
+
+class Reservation(object):
+
+    def __init__(self, budget, size):
+        self.budget = budget
+        self.size = size
+
+    def resize(self, size):
+        """ Change the reservation to size bytes. Growing gives back the current bytes before
+        waiting for the new amount, so no reservation is held while waiting.
+        """
+        size = min(max(int(size), 0), self.budget.capacity)
+        if size <= self.size:
+            self.budget.release(self.size - size)
+        else:
+            self.budget.release(self.size)
+            self.size = 0
+            self.budget.acquire(size)
+        self.size = size
+
+
+pad_budget = MemoryBudget('pads', MEMORY_BUDGET * PAD_SHARE)
+image_budget = MemoryBudget('images', MEMORY_BUDGET - pad_budget.capacity)
+metrics.Gauge('hackpad_memory_budget', 'Bytes reserved for data in flight now and at the peak, and waiting reservations',
+              lambda: dict(list(pad_budget.counters().items()) + list(image_budget.counters().items())),
+              label='budget')
@@ -0,0 +1,212 @@
+"""
+Metrics of a worker, served in the Prometheus text format on a local port.
+
+Every stage of the pipeline (see hub.stage) records its latency in the
+hackpad_stage_seconds histogram. Counters track pads and bytes, gauges are read when
+the endpoint is scraped. Observations may come from the threadpool, so the metrics are
+guarded by a native lock and never touch gevent.
+"""
+
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+from gevent import monkey
+from logger import logging
+
+# Local port of the endpoint, 0 disables it. Workers of a fleet add their index.
+METRICS_PORT = int(os.environ.get('HACKPAD_METRICS_PORT') or 9187)
+# Seconds over which the pads per second are averaged
+RATE_WINDOW = 60
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+_lock = monkey.get_original('_thread', 'allocate_lock')()
+_registry = []
+
+
+def _labels(label, value):
+    return '{%s="%s"}' % (label, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+
+
+class Histogram(object):
+
+    def __init__(self, name, help, label, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self._series = {} # label value -> [count per bucket..., count above, sum]
+        _registry.append(self)
+
+    def observe(self, label_value, value):
+        with _lock:
+            counts = self._series.get(label_value)
+            if counts is None:
+                counts = self._series[label_value] = [0] * (len(self.buckets) + 1) + [0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    break
+            else:
+                index = len(self.buckets)
+            counts[index] += 1
+            counts[-1] += value
+
+    def totals(self, label_value):
+        """ Return the number and the sum of the observations of label_value """
+        with _lock:
+            counts = self._series.get(label_value)
+            if counts is None:
+                return 0, 0.0
+            return sum(counts[:-1]), counts[-1]
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        with _lock:
+            series = [(label_value, list(counts)) for label_value, counts in self._series.items()]
+        for label_value, counts in sorted(series):
+            labels = _labels(self.label, label_value)[:-1]
+            total = 0
+            for bound, count in zip(self.buckets, counts):
+                total += count
+                lines.append('%s_bucket%s,le="%s"} %d' % (self.name, labels, bound, total))
+            total += counts[len(self.buckets)]
+            lines.append('%s_bucket%s,le="+Inf"} %d' % (self.name, labels, total))
+            lines.append('%s_sum%s} %f' % (self.name, labels, counts[-1]))
+            lines.append('%s_count%s} %d' % (self.name, labels, total))
+        return lines
+
+
+class Counter(object):
+
+    def __init__(self, name, help, label):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, label_value, amount=1):
+        with _lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def value(self, label_value):
+        with _lock:
+            return self._values.get(label_value, 0)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s counter' % self.name]
+        with _lock:
+            values = sorted(self._values.items())
+        for label_value, value in values:
+            lines.append('%s%s %s' % (self.name, _labels(self.label, label_value), value))
+        return lines
+
+
+class Gauge(object):
+    """ A value read when the metrics are scraped. func returns a number, or a dict of
+    label value -> number when label is set. kind is the Prometheus type, so counters
+    kept elsewhere can be exposed as counters.
+    """
+
+    def __init__(self, name, help, func, label=None, kind='gauge'):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.label = label
+        self.kind = kind
+        _registry.append(self)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+        try:
+            value = self.func()
+        except Exception as err:
+            lines.append('# %s failed: %s' % (self.name, err))
+            return lines
+        if self.label is None:
+            lines.append('%s %s' % (self.name, value))
+        else:
+            for label_value, number in sorted(value.items()):
+                lines.append('%s%s %s' % (self.name, _labels(self.label, label_value), number))
+        return lines
+
+
+class Meter(object):
+    """ Events per second over the last RATE_WINDOW seconds """
+
+    def __init__(self, window=RATE_WINDOW):
+        self.window = window
+        self._seconds = deque() # [second, events], oldest first
+
+    def mark(self, events=1):
+        now = int(time.monotonic())
+        with _lock:
+            if self._seconds and self._seconds[-1][0] == now:
+                self._seconds[-1][1] += events
+            else:
+                self._seconds.append([now, events])
+            self._expire(now)
+
+    def rate(self):
+        now = int(time.monotonic())
+        with _lock:
+            self._expire(now)
+            return sum(events for second, events in self._seconds) / self.window
+
+    def _expire(self, now):
+        while self._seconds and self._seconds[0][0] <= now - self.window:
+            self._seconds.popleft()
+
+
+stage_seconds = Histogram('hackpad_stage_seconds', 'Latency of the stages of the import pipeline', 'stage')
+pads = Counter('hackpad_pads_total', 'Files of the imported zips by result', 'result')
+bytes_processed = Counter('hackpad_bytes_total', 'Bytes processed by kind', 'kind')
+pads_created = Meter()
+Gauge('hackpad_pads_per_second', 'Pads created per second over the last %d seconds' % RATE_WINDOW,
+      pads_created.rate)
+
+
+@contextmanager
+def timed(stage):
+    """ Record the duration of the with block as stage """
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(stage, time.monotonic() - start)
+
+
+def render():
+    """ All metrics in the Prometheus text format """
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def application(environ, start_response):
+    if environ.get('PATH_INFO') != '/metrics':
+        start_response('404 Not Found', [('Content-Type', 'text/plain')])
+        return [b'Not found\n']
+    body = render().encode('utf-8')
+    start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4'),
+                              ('Content-Length', str(len(body)))])
+    return [body]
+
+
+def serve(port=None):
+    """ Serve /metrics on localhost from a greenlet, return the server or None when disabled
+    or when the port is taken (like by another worker started by hand)
+    """
+    from gevent.pywsgi import WSGIServer
+    if port is None:
+        port = METRICS_PORT and METRICS_PORT + int(os.environ.get('HACKPAD_WORKER_INDEX') or 0)
+    if not port:
+        return None
+    server = WSGIServer(('127.0.0.1', port), application, log=None)
+    try:
+        server.start()
+    except OSError as err:
+        logging.warning('Not serving metrics on port %d: %s' % (port, err))
+        return None
+    return server
@@ -0,0 +1,64 @@
+"""
+Fingerprints of pad contents, to skip pads that need no import.
+
+A fingerprint is the SHA-1 of the pad html with its whitespace normalized. Pads whose
+fingerprint is in BOILERPLATE are hackpad's own filler (like the pad every new hackpad
+starts with). The fingerprints of the pads imported for an account are kept in Redis,
+so a re-sent or overlapping export only imports the pads that are new for the account.
+"""
+
+import hashlib
+import os
+import re
+
+WHITESPACE_RE = re.compile(r'\s+')
+
+# Pads hackpad creates by itself
+BOILERPLATE_PADS = (
+    '<body><h1>Untitled</h1><p></p><p>This pad text is synchronized as you type, so that everyone viewing this page sees the same text.&nbsp; This allows you to collaborate seamlessly on documents!</p><p></p><p></p></body>',
+)
+
+
+def fingerprint(html_pad):
+    """ Hex fingerprint of the contents of a pad """
+    return hashlib.sha1(WHITESPACE_RE.sub(' ', html_pad).strip().encode('utf-8')).hexdigest()
+
+
+# more can be added as a comma separated list of fingerprints
+BOILERPLATE = frozenset([fingerprint(html_pad) for html_pad in BOILERPLATE_PADS] +
+                        [value.strip() for value in (os.environ.get('HACKPAD_BOILERPLATE_FINGERPRINTS') or '').split(',')
+                         if value.strip()])
+
+
+def index_key(account_id):
+    return 'hackpad_pad_fingerprints:%s' % account_id
+
+
+class PadIndex(object):
+
+    def __init__(self, rdb=None):
+        self.rdb = rdb
+        self.duplicates = 0
+
+    def attach(self, rdb):
+        self.rdb = rdb
+
+    def lookup(self, account_id, pad_fingerprint):
+        """ Return the globalPadId of the pad with this fingerprint that was imported for
+        the account before, or None
+        """
+        if self.rdb is None:
+            return None
+        pad_id = self.rdb.hget(index_key(account_id), pad_fingerprint)
+        if pad_id is None:
+            return None
+        self.duplicates += 1
+        return pad_id.decode()
+
+    def add(self, account_id, pad_fingerprint, pad_id):
+        """ Record that the pad with this fingerprint was imported as pad_id """
+        if self.rdb is not None:
+            self.rdb.hset(index_key(account_id), pad_fingerprint, pad_id)
+
+
+pad_index = PadIndex()
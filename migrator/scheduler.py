@@ -0,0 +1,184 @@
+"""
+Size-aware, fair scheduling of the jobs of a worker.
+
+Popped jobs are put in a size class by their zip's central directory (number of members
+and uncompressed size), without extracting anything. Of the job slots of the worker,
+HACKPAD_SMALL_JOB_SLOTS are reserved for small jobs and at most HACKPAD_LARGE_JOB_SLOTS
+run large jobs, so single pad exports don't queue up behind a 10,000 pad one. Within a
+class the sender with the fewest running jobs goes first, then the one that waited
+longest. Jobs that waited more than HACKPAD_SCHEDULER_MAX_WAIT seconds go before the
+smaller classes. A worker only keeps the popped jobs that can start in a free slot of
+their class, fewest running jobs of the sender first. The others go back to the queue
+for the worker's next look or for another worker, so a worker that runs large jobs
+doesn't sit on the queue while its reserved small slots stay empty.
+"""
+
+import os
+import time
+import zipfile
+from collections import OrderedDict, deque
+import metrics
+
+SMALL_JOB_PADS = int(os.environ.get('HACKPAD_SMALL_JOB_PADS') or 50)
+SMALL_JOB_BYTES = int(os.environ.get('HACKPAD_SMALL_JOB_BYTES') or 20 * 1024 * 1024)
+MEDIUM_JOB_PADS = int(os.environ.get('HACKPAD_MEDIUM_JOB_PADS') or 1000)
+MEDIUM_JOB_BYTES = int(os.environ.get('HACKPAD_MEDIUM_JOB_BYTES') or 500 * 1024 * 1024)
+SMALL_JOB_SLOTS = int(os.environ.get('HACKPAD_SMALL_JOB_SLOTS') or 1)
+LARGE_JOB_SLOTS = int(os.environ.get('HACKPAD_LARGE_JOB_SLOTS') or 1)
+# Max number of jobs that wait in the worker for a slot of their class
+SCHEDULER_WINDOW = int(os.environ.get('HACKPAD_SCHEDULER_WINDOW') or 10)
+# Seconds after which a waiting job goes before the smaller ones, so they can't starve it
+SCHEDULER_MAX_WAIT = float(os.environ.get('HACKPAD_SCHEDULER_MAX_WAIT') or 600)
+
+SIZE_CLASSES = ('small', 'medium', 'large')
+
+wait_seconds = metrics.Histogram('hackpad_scheduler_wait_seconds',
+                                 'Time jobs waited in the worker for a slot, by size class', 'class')
+
+
+def inspect_zip(attachment):
+    """ Return the number of members and their uncompressed size, from the central
+    directory of the zip. Runs in the threadpool.
+    """
+    with zipfile.ZipFile(attachment, 'r') as zip_ref:
+        infos = [info for info in zip_ref.infolist() if not info.filename.endswith('/')]
+    return len(infos), sum(info.file_size for info in infos)
+
+
+def size_class(members, size):
+    if members <= SMALL_JOB_PADS and size <= SMALL_JOB_BYTES:
+        return 'small'
+    if members <= MEDIUM_JOB_PADS and size <= MEDIUM_JOB_BYTES:
+        return 'medium'
+    return 'large'
+
+
+class ScheduledJob(object):
+
+    def __init__(self, job_id, job, raw_job, members, size, account=None):
+        self.job_id = job_id
+        self.job = job
+        self.raw_job = raw_job
+        self.account = account
+        self.members = members
+        self.size = size
+        self.size_class = size_class(members, size)
+        self.sender = job['email_address'].lower()
+        self.added = time.monotonic()
+
+
+class Scheduler(object):
+
+    def __init__(self, slots, small_slots=SMALL_JOB_SLOTS, large_slots=LARGE_JOB_SLOTS, window=SCHEDULER_WINDOW):
+        self._small_slots = small_slots
+        self._large_slots = large_slots
+        self.resize(slots)
+        self.window = window
+        self.running = dict((name, 0) for name in SIZE_CLASSES)
+        self._by_sender = {}
+        self._waiting = dict((name, OrderedDict()) for name in SIZE_CLASSES) # sender -> deque of jobs
+        metrics.Gauge('hackpad_scheduler_jobs', 'Jobs of the worker by size class and state', self._counts,
+                      label='jobs')
+
+    def resize(self, slots):
+        """ Change the number of jobs that may run. Running jobs above it finish, no new
+        ones start until the worker is under it.
+        """
+        self.slots = slots
+        # never reserve all slots, and let large jobs use what is not reserved
+        self.small_slots = max(min(self._small_slots, slots - 1), 0)
+        self.large_slots = min(max(self._large_slots, 1), slots - self.small_slots)
+
+    def _counts(self):
+        counts = {}
+        for name in SIZE_CLASSES:
+            counts['%s waiting' % name] = self.waiting(name)
+            counts['%s running' % name] = self.running[name]
+        return counts
+
+    def add(self, job):
+        self._waiting[job.size_class].setdefault(job.sender, deque()).append(job)
+
+    def waiting(self, name=None):
+        if name is None:
+            return sum(self.waiting(name) for name in SIZE_CLASSES)
+        return sum(len(jobs) for jobs in self._waiting[name].values())
+
+    def can_pop(self):
+        """ True if a job of some class could start and there is room for more waiting jobs """
+        counts = self._committed()
+        return self.waiting() < self.window and any(self._has_slot(name, counts) for name in SIZE_CLASSES)
+
+    def split(self, jobs):
+        """ Return the jobs that can start in the free slots, fewest running jobs of their
+        sender first, and the ones that can't, both in their original order
+        """
+        counts = self._committed()
+        senders = dict(self._by_sender)
+        pending = list(jobs)
+        fitting = []
+        while pending and len(fitting) + self.waiting() < self.window:
+            fits = [job for job in pending if self._has_slot(job.size_class, counts)]
+            if not fits:
+                break
+            job = min(fits, key=lambda job: senders.get(job.sender, 0))
+            pending.remove(job)
+            fitting.append(job)
+            counts[job.size_class] += 1
+            senders[job.sender] = senders.get(job.sender, 0) + 1
+        return [job for job in jobs if job in fitting], pending
+
+    def next_job(self):
+        """ Return the next job to start and count it as running, or None """
+        now = time.monotonic()
+        starving = [name for name in SIZE_CLASSES if self._oldest(name, now) > SCHEDULER_MAX_WAIT]
+        for name in starving + [name for name in SIZE_CLASSES if name not in starving]:
+            if not self._waiting[name] or not self._has_slot(name):
+                continue
+            # fewest running jobs first, then the sender that waited longest
+            senders = self._waiting[name]
+            sender = min(senders, key=lambda sender: self._by_sender.get(sender, 0))
+            job = senders[sender].popleft()
+            if senders[sender]:
+                senders.move_to_end(sender)
+            else:
+                del senders[sender]
+            self.running[name] += 1
+            self._by_sender[sender] = self._by_sender.get(sender, 0) + 1
+            wait_seconds.observe(name, now - job.added)
+            return job
+        return None
+
+    def finished(self, job):
+        self.running[job.size_class] -= 1
+        self._by_sender[job.sender] -= 1
+        if not self._by_sender[job.sender]:
+            del self._by_sender[job.sender]
+
+    def drain_waiting(self):
+        """ Remove and return the jobs that did not start """
+        jobs = []
+        for name in SIZE_CLASSES:
+            for sender_jobs in self._waiting[name].values():
+                jobs.extend(sender_jobs)
+            self._waiting[name].clear()
+        return jobs
+
+    def _oldest(self, name, now):
+        """ Seconds the longest waiting job of the class waited """
+        return max([now - jobs[0].added for jobs in self._waiting[name].values()] or [0])
+
+    def _committed(self):
+        """ Running and waiting jobs per class, the waiting ones start next """
+        return dict((name, self.running[name] + self.waiting(name)) for name in SIZE_CLASSES)
+
+    def _has_slot(self, name, counts=None):
+        counts = counts or self.running
+        running = sum(counts.values())
+        if running >= self.slots:
+            return False
+        if name == 'small':
+            return True
+        if running - counts['small'] >= self.slots - self.small_slots:
+            return False
+        return name != 'large' or counts['large'] < self.large_slots
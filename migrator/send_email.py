@@ -1,12 +1,142 @@
 import smtplib
 import os
+import gevent
+from gevent.queue import JoinableQueue, Empty
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from logger import logging
+from hub import stage
+import metrics
 
 smtp_host = os.environ.get('HACKPAD_SMPT_HOST') or 'localhost'
 smtp_port = os.environ.get('HACKPAD_SMPT_PORT') or 1025
 smtp_user = os.environ.get('HACKPAD_SMPT_USER') or ''
 smtp_password = os.environ.get('HACKPAD_SMPT_PASSWORD') or ''
+# Max number of messages sent over the SMTP session in one go
+smtp_batch_size = int(os.environ.get('HACKPAD_SMTP_BATCH_SIZE') or 50)
+# Seconds an unused SMTP session is kept open
+smtp_idle_timeout = float(os.environ.get('HACKPAD_SMTP_IDLE_TIMEOUT') or 30)
+
+
+class Outbox(object):
+    """ Queue of outgoing messages. A single sender greenlet sends them over one
+    authenticated SMTP session that is reused as long as there is mail to send, so
+    nobody waits for the SMTP server.
+    """
+
+    def __init__(self):
+        self._queue = JoinableQueue()
+        self._sender = None
+        self._smtp = None
+        self._digests = {}
+        self.sent = 0
+        self.failed = 0
+
+    def put(self, msg):
+        """ Queue msg for sending """
+        self._queue.put(msg)
+        if self._sender is None or self._sender.dead:
+            self._sender = gevent.spawn(self._send_loop)
+
+    def open_digest(self, key):
+        """ Collect the errors for key (a job id) into one digest mail from now on """
+        self._digests.setdefault(key, [])
+
+    def add_to_digest(self, key, text):
+        """ Add text to the digest of key, return False if there is no digest open for it """
+        if key not in self._digests:
+            return False
+        self._digests[key].append(text)
+        return True
+
+    def close_digest(self, key, me, you, subject):
+        """ Queue the digest of key as one mail, if anything was added to it """
+        texts = self._digests.pop(key, None)
+        if texts:
+            send_text_email(me, you, '%s (%d)' % (subject, len(texts)), '\n\n'.join(texts))
+
+    def flush(self):
+        """ Wait until all queued messages are handed to the SMTP server """
+        self._queue.join()
+
+    def _send_loop(self):
+        while True:
+            try:
+                msg = self._queue.get(timeout=smtp_idle_timeout)
+            except Empty:
+                self._disconnect()
+                # put() does not start a sender while this one waits for quit()
+                if self._queue.empty():
+                    return
+                continue
+            batch = [msg]
+            while len(batch) < smtp_batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            for msg in batch:
+                try:
+                    with stage('email'):
+                        self._send(msg)
+                except Exception:
+                    self.failed += 1
+                    logging.exception('Could not send mail "%s" to %s' % (msg['Subject'], msg['To']))
+                finally:
+                    self._queue.task_done()
+
+    def _send(self, msg):
+        for attempt in range(2):
+            try:
+                if self._smtp is None:
+                    self._smtp = smtp_connect()
+                self._smtp.send_message(msg)
+                self.sent += 1
+                return
+            except (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError) as err:
+                # the session went away, reconnect once
+                logging.warning('SMTP session lost: %s' % err)
+                self._close()
+            except smtplib.SMTPException as err:
+                # refused by the server (like a bad recipient), the session is fine.
+                # SMTPException is an OSError, so this goes before the socket errors.
+                logging.error('Could not send mail "%s" to %s: %s' % (msg['Subject'], msg['To'], err))
+                break
+            except OSError as err:
+                logging.warning('SMTP session lost: %s' % err)
+                self._close()
+        self.failed += 1
+
+    def _disconnect(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._close()
+
+    def _close(self):
+        """ Drop the session without talking to the server """
+        if self._smtp is not None:
+            self._smtp.close()
+            self._smtp = None
+
+
+def smtp_connect():
+    """ Open an (authenticated) session with our own SMTP server """
+    s = smtplib.SMTP(smtp_host, smtp_port)
+    if smtp_user and smtp_password:
+        s.ehlo()
+        s.starttls()
+        s.login(smtp_user, smtp_password)
+    return s
+
+
+outbox = Outbox()
+metrics.Gauge('hackpad_outbox_messages', 'Mails of the outbox by state',
+              lambda: {'queued': outbox._queue.qsize(), 'sent': outbox.sent, 'failed': outbox.failed},
+              label='state')
+
 
 def send_html_email(me, you, subject, html, text, bcc=''):
 
@@ -28,16 +158,8 @@ def send_html_email(me, you, subject, html, text, bcc=''):
     msg.attach(part1)
     msg.attach(part2)
 
-    # Send the message via local SMTP server.
-    s = smtplib.SMTP(smtp_host, smtp_port)
-    if smtp_user and smtp_password:
-        s.ehlo()
-        s.starttls()
-        s.login(smtp_user, smtp_password)
-    # sendmail function takes 3 arguments: sender's address, recipient's address
-    # and message to send - here it is sent as one string.
-    s.sendmail(me, you, msg.as_string())
-    s.quit()
+    # Send the message via our own SMTP server, in the background.
+    outbox.put(msg)
 
 
     
@@ -50,15 +172,8 @@ def send_text_email(me, you, subject, text, bcc=''):
     if bcc:
         msg['Bcc'] = bcc
     
-    # Send the message via our own SMTP server.
-    s = smtplib.SMTP(smtp_host, smtp_port)
-    if smtp_user and smtp_password:
-        s.ehlo()
-        s.starttls()
-        s.login(smtp_user, smtp_password)
-
-    s.send_message(msg)
-    s.quit()
+    # Send the message via our own SMTP server, in the background.
+    outbox.put(msg)
 
 
 
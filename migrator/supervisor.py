@@ -0,0 +1,136 @@
+"""
+Runs a fleet of migrator worker processes on one box.
+
+Starts HACKPAD_WORKERS (default: number of cores) copies of migrator/__init__.py, which
+all consume the same hackpad_imports queue, and restarts the ones that die. On SIGTERM
+or SIGINT the workers are asked to drain: they stop taking jobs and finish the running
+ones. Workers that don't finish within HACKPAD_DRAIN_TIMEOUT seconds are killed. The
+heartbeat of a dead worker is removed, so the other workers reclaim its jobs right away
+instead of after the heartbeat expires.
+"""
+
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import redis
+from logger import logging
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '__init__.py')
+WORKERS = int(os.environ.get('HACKPAD_WORKERS') or os.cpu_count() or 1)
+DRAIN_TIMEOUT = int(os.environ.get('HACKPAD_DRAIN_TIMEOUT') or 600)
+# Seconds between the aggregated stats in the log
+STATS_INTERVAL = int(os.environ.get('HACKPAD_STATS_INTERVAL') or 60)
+# Max seconds to wait before restarting a worker that keeps crashing
+MAX_RESTART_DELAY = 60
+
+
+class Worker(object):
+
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.started = 0
+        self.restart_delay = 1
+        self.restart_at = 0
+
+    def start(self):
+        env = dict(os.environ, HACKPAD_WORKER_INDEX=str(self.index))
+        # in its own session, so a Ctrl-C reaches the supervisor only and workers drain
+        self.process = subprocess.Popen([sys.executable, WORKER_SCRIPT], env=env, start_new_session=True)
+        self.started = time.monotonic()
+        logging.info('Started worker %d with pid %d' % (self.index, self.process.pid))
+
+    def worker_id(self):
+        """ The id the worker uses for its heartbeat and stats in Redis """
+        return '%s:%d' % (socket.gethostname(), self.process.pid)
+
+    def forget(self, rdb):
+        """ Remove the heartbeat of the dead worker, making its jobs orphans """
+        try:
+            rdb.delete('hackpad_worker:%s' % self.worker_id())
+        except redis.RedisError as err:
+            logging.warning('Could not remove the heartbeat of worker %d: %s' % (self.index, err))
+
+
+def supervise():
+    rdb = redis.StrictRedis(host=os.environ.get('HACKPAD_REDIS_HOST') or '127.0.0.1',
+                            port=os.environ.get('HACKPAD_REDIS_PORT') or '6379',
+                            db=os.environ.get('HACKPAD_REDIS_DB') or 9)
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.append(signum))
+
+    workers = [Worker(index) for index in range(WORKERS)]
+    for worker in workers:
+        worker.start()
+
+    last_stats = time.monotonic()
+    while not stopping:
+        time.sleep(1)
+        now = time.monotonic()
+        for worker in workers:
+            if worker.process is None:
+                if now >= worker.restart_at:
+                    worker.start()
+                continue
+            code = worker.process.poll()
+            if code is None:
+                continue
+            # back off when a worker dies right after it started
+            if now - worker.started < MAX_RESTART_DELAY:
+                worker.restart_delay = min(worker.restart_delay * 2, MAX_RESTART_DELAY)
+            else:
+                worker.restart_delay = 1
+            logging.error('Worker %d (pid %d) exited with %s, restarting in %ds' % (
+                worker.index, worker.process.pid, code, worker.restart_delay))
+            worker.forget(rdb)
+            worker.process = None
+            worker.restart_at = now + worker.restart_delay
+        if now - last_stats >= STATS_INTERVAL:
+            log_stats(rdb, workers)
+            last_stats = now
+
+    drain(rdb, workers)
+    log_stats(rdb, workers)
+
+
+def drain(rdb, workers):
+    """ Ask all workers to finish their jobs, kill the ones that take too long """
+    running = [worker for worker in workers if worker.process is not None]
+    logging.info('Draining %d workers' % len(running))
+    for worker in running:
+        worker.process.send_signal(signal.SIGTERM)
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    for worker in running:
+        try:
+            worker.process.wait(timeout=max(deadline - time.monotonic(), 0))
+        except subprocess.TimeoutExpired:
+            logging.warning('Worker %d did not drain in time, killing it' % worker.index)
+            worker.process.kill()
+            worker.process.wait()
+            worker.forget(rdb)
+
+
+def log_stats(rdb, workers):
+    """ Log the counters of all workers and their totals """
+    totals = {}
+    for worker in workers:
+        if worker.process is None:
+            continue
+        try:
+            stats = rdb.hgetall('hackpad_worker_stats:%s' % worker.worker_id())
+        except redis.RedisError as err:
+            logging.warning('Could not read worker stats: %s' % err)
+            return
+        stats = dict((name.decode(), int(value)) for name, value in stats.items())
+        logging.info('Worker %d: %s' % (worker.index, stats))
+        for name, value in stats.items():
+            totals[name] = totals.get(name, 0) + value
+    logging.info('All workers: %s' % totals)
+
+
+if __name__ == '__main__':
+    supervise()